@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+"""
+Generate synthetic Activity Streams tweets for benchmarking, with control
+over volume, time span, retweet ratio and payload size.
+
+Tweets are written one JSON object per line, in time order, with the scalar
+top-level keys ('id', 'objectType', 'verb', 'postedTime') before the nested
+objects. With several output files, the time span is split evenly between
+them, as for an archive of hourly files.
+"""
+
+import argparse
+import datetime
+import json
+import random
+
+TWITTER_DT_FORMAT_STR = "%Y-%m-%dT%H:%M:%S.000Z"
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut '
+        'labore et dolore magna aliqua enim ad minim veniam quis nostrud exercitation ullamco laboris').split()
+
+def make_tweet(rng,tweet_id,posted_time,retweet_ratio,payload_size,n_users,n_hashtags):
+    """ make one tweet, with a body and padding that bring its size to about 'payload_size' bytes """
+    user_id = rng.randrange(n_users)
+    hashtags = ['tag{}'.format(int(rng.paretovariate(1.2)) % n_hashtags) for _ in range(rng.randrange(3))]
+    mentions = ['user{}'.format(rng.randrange(n_users)) for _ in range(rng.randrange(2))]
+    body = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(5,20)))
+    body += ''.join(' #' + hashtag for hashtag in hashtags) + ''.join(' @' + mention for mention in mentions)
+    verb = 'share' if rng.random() < retweet_ratio else 'post'
+    tweet = {'id':'tag:search.twitter.com,2005:{}'.format(tweet_id),
+            'objectType':'activity',
+            'verb':verb,
+            'postedTime':posted_time.strftime(TWITTER_DT_FORMAT_STR),
+            'body':('RT @user{}: '.format(rng.randrange(n_users)) if verb == 'share' else '') + body,
+            'actor':{'id':'id:twitter.com:{}'.format(user_id),
+                'objectType':'person',
+                'preferredUsername':'user{}'.format(user_id),
+                'displayName':'User {}'.format(user_id),
+                'followersCount':rng.randrange(10000),
+                'friendsCount':rng.randrange(1000)},
+            'twitter_entities':{'hashtags':[{'text':hashtag} for hashtag in hashtags],
+                'user_mentions':[{'screen_name':mention} for mention in mentions],
+                'urls':[]},
+            'retweetCount':rng.randrange(100)}
+    padding = payload_size - len(json.dumps(tweet))
+    if padding > 0:
+        tweet['gnip'] = {'padding':'x'*padding}
+    return tweet
+
+def generate_tweets(num_tweets,start_time,time_span,retweet_ratio=0.3,payload_size=2000,
+        n_users=10000,n_hashtags=1000,seed=0):
+    """ yield serialized tweets, evenly spread in time over 'time_span' seconds from 'start_time' """
+    rng = random.Random(seed)
+    for i in range(num_tweets):
+        posted_time = start_time + datetime.timedelta(seconds=time_span*i//max(num_tweets,1))
+        yield json.dumps(make_tweet(rng,i,posted_time,retweet_ratio,payload_size,n_users,n_hashtags))
+
+def write_tweet_files(file_names,num_tweets,start_time,time_span,**kwargs):
+    """ write the tweets to 'file_names', each holding an equal share of the time span """
+    tweets = generate_tweets(num_tweets,start_time,time_span,**kwargs)
+    for file_idx,file_name in enumerate(file_names):
+        n_file_tweets = num_tweets*(file_idx + 1)//len(file_names) - num_tweets*file_idx//len(file_names)
+        with open(file_name,'w') as f:
+            for _ in range(n_file_tweets):
+                f.write(next(tweets) + '\n')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('-n','--num-tweets',dest='num_tweets',type=int,default=100000,
+            help='number of tweets; default is %(default)s')
+    parser.add_argument('-s','--start-time',dest='start_time',default='2016-06-16T00:00:00',
+            help='time of the first tweet; default is %(default)s')
+    parser.add_argument('-d','--time-span',dest='time_span',type=int,default=86400,
+            help='seconds spanned by the tweets; default is %(default)s')
+    parser.add_argument('-r','--retweet-ratio',dest='retweet_ratio',type=float,default=0.3,
+            help='fraction of tweets that are retweets; default is %(default)s')
+    parser.add_argument('-p','--payload-size',dest='payload_size',type=int,default=2000,
+            help='approximate size in bytes of each tweet; default is %(default)s')
+    parser.add_argument('-u','--users',dest='n_users',type=int,default=10000,
+            help='number of distinct users; default is %(default)s')
+    parser.add_argument('--seed',dest='seed',type=int,default=0,
+            help='random seed; default is %(default)s')
+    parser.add_argument('-o','--output-files',dest='output_files',nargs='+',default=None,
+            help='files to write, splitting the time span between them; default is stdout')
+    args = parser.parse_args()
+
+    start_time = datetime.datetime.strptime(args.start_time,'%Y-%m-%dT%H:%M:%S')
+    kwargs = dict(retweet_ratio=args.retweet_ratio,payload_size=args.payload_size,n_users=args.n_users,seed=args.seed)
+    if args.output_files is None:
+        for tweet in generate_tweets(args.num_tweets,start_time,args.time_span,**kwargs):
+            print(tweet)
+    else:
+        write_tweet_files(args.output_files,args.num_tweets,start_time,args.time_span,**kwargs)
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+
+"""
+Scenario benchmarks of tweet_enricher.py and tweet_time_series_builder.py
+over synthetic tweets, with results recorded as JSON.
+
+The enrichment scenarios run an enrichment doing a fixed amount of CPU work
+(and optionally sleeping) per tweet, with the simple architecture (-s),
+threads and processes (-p), at each number of workers. The aggregation
+scenarios run the builder at each bucket size, with each number of keyword
+counting measurements and input files. Each scenario runs '--repeat' times,
+and the fastest run is reported. With '--baseline', the change in time
+from a previous results file is logged for each scenario.
+"""
+
+import argparse
+import datetime
+import json
+import multiprocessing as mp
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+from generate_tweets import write_tweet_files
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),'..')
+ENRICHER_SCRIPT = os.path.join(REPO_DIR,'tweet_enricher.py')
+BUILDER_SCRIPT = os.path.join(REPO_DIR,'tweet_time_series_builder.py')
+
+ENRICHMENT_CONFIG = '''
+import os
+import time
+WORK = int(os.environ['BENCH_ENRICHMENT_WORK'])
+SLEEP = float(os.environ['BENCH_ENRICHMENT_SLEEP'])
+class WorkEnrichment(object):
+    """ does a fixed amount of CPU work, and optionally sleeps, for each tweet """
+    def enrich(self,tweet):
+        total = 0
+        for i in range(WORK):
+            total += i
+        if SLEEP > 0:
+            time.sleep(SLEEP)
+        tweet.setdefault('enrichments',{})['WorkEnrichment'] = total
+enrichment_class_list = [(WorkEnrichment,int(os.environ['BENCH_N_WORKERS']))]
+'''
+
+MEASUREMENT_CONFIG = '''
+import os
+WORDS = {words!r}
+class KeywordCounter(object):
+    """ counts tweets with a keyword in the body """
+    keyword = None
+    def __init__(self, **kwargs):
+        self.counter = 0
+    def add_tweet(self,tweet):
+        if self.keyword in tweet['body']:
+            self.counter += 1
+    def get(self):
+        return [(self.counter,self.get_name())]
+    def get_name(self):
+        return type(self).__name__
+    def combine(self,new):
+        self.counter += new.counter
+measurement_class_list = []
+for i in range(int(os.environ['BENCH_N_MEASUREMENTS'])):
+    # module-level names let the pool pickle instances
+    name = 'KeywordCounter{{}}'.format(i)
+    globals()[name] = type(name,(KeywordCounter,),{{'keyword':WORDS[i % len(WORDS)]}})
+    measurement_class_list.append(globals()[name])
+'''
+
+def time_command(command,repeat,input_file_name=None,env=None):
+    """ run a command 'repeat' times, with its output discarded, and return the times in seconds """
+    times = []
+    for _ in range(repeat):
+        with open(input_file_name or os.devnull) as input_file:
+            start_time = time.perf_counter()
+            subprocess.check_call(command,stdin=input_file,stdout=subprocess.DEVNULL,env=env)
+            times.append(time.perf_counter() - start_time)
+    return times
+
+def make_result(scenario,params,times,num_tweets):
+    return dict(scenario=scenario,params=params,seconds=round(min(times),4),
+            all_seconds=[round(t,4) for t in times],tweets_per_second=round(num_tweets/min(times),1))
+
+def run_enrichment_scenarios(args,tmp_dir,input_file_name):
+    config_file_name = os.path.join(tmp_dir,'bench_enrichments.py')
+    with open(config_file_name,'w') as f:
+        f.write(ENRICHMENT_CONFIG)
+    results = []
+    for mode,options in [('simple',['-s']),('threads',[]),('processes',['-p'])]:
+        # the simple architecture runs the enrichment in the main thread
+        for n_workers in ([1] if mode == 'simple' else args.workers):
+            env = dict(os.environ,BENCH_ENRICHMENT_WORK=str(args.enrichment_work),
+                    BENCH_ENRICHMENT_SLEEP=str(args.enrichment_sleep),BENCH_N_WORKERS=str(n_workers))
+            command = [sys.executable,ENRICHER_SCRIPT,'-c',config_file_name,'-b',str(args.batch_size)] + options
+            times = time_command(command,args.repeat,input_file_name,env)
+            results.append(make_result('enrich',dict(mode=mode,n_workers=n_workers,batch_size=args.batch_size),
+                times,args.num_tweets))
+            log_result(results[-1])
+    return results
+
+def run_aggregation_scenarios(args,tmp_dir,start_time):
+    config_file_name = os.path.join(tmp_dir,'bench_measurements.py')
+    with open(config_file_name,'w') as f:
+        f.write(MEASUREMENT_CONFIG.format(words=['lorem','ipsum','dolor','sit','amet','tempor','magna','veniam']))
+    results = []
+    for n_files in args.files:
+        file_names = [os.path.join(tmp_dir,'tweets_{}_{}.json'.format(n_files,i)) for i in range(n_files)]
+        write_tweet_files(file_names,args.num_tweets,start_time,args.time_span,
+                retweet_ratio=args.retweet_ratio,payload_size=args.payload_size)
+        for bucket_size in args.bucket_sizes:
+            for n_measurements in args.measurements:
+                env = dict(os.environ,BENCH_N_MEASUREMENTS=str(n_measurements))
+                command = [sys.executable,BUILDER_SCRIPT,'-c',config_file_name,'-b',bucket_size,
+                        '-p',str(args.num_cpu),'-i'] + file_names
+                times = time_command(command,args.repeat,env=env)
+                results.append(make_result('aggregate',dict(bucket_size=bucket_size,n_measurements=n_measurements,
+                    n_files=n_files,num_cpu=args.num_cpu),times,args.num_tweets))
+                log_result(results[-1])
+        for file_name in file_names:
+            os.remove(file_name)
+    return results
+
+def log_result(result):
+    sys.stderr.write('{} {}: {:.3f} s, {:.0f} tweets/s\n'.format(result['scenario'],
+        json.dumps(result['params'],sort_keys=True),result['seconds'],result['tweets_per_second']))
+
+def compare_results(results,baseline_results):
+    """ log the change in time of each scenario that is also in the baseline results """
+    get_key = lambda result: (result['scenario'],json.dumps(result['params'],sort_keys=True))
+    baseline_seconds = {get_key(result):result['seconds'] for result in baseline_results}
+    for result in results:
+        key = get_key(result)
+        if key in baseline_seconds:
+            sys.stderr.write('{} {}: {:.3f} s -> {:.3f} s ({:+.1f}%)\n'.format(key[0],key[1],
+                baseline_seconds[key],result['seconds'],100.*(result['seconds']/baseline_seconds[key] - 1)))
+
+def get_git_commit():
+    try:
+        return subprocess.check_output(['git','rev-parse','HEAD'],cwd=REPO_DIR,stderr=subprocess.DEVNULL).decode('utf8').strip()
+    except (OSError,subprocess.CalledProcessError):
+        return None
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--scenarios',dest='scenarios',nargs='+',choices=['enrich','aggregate'],default=['enrich','aggregate'],
+            help='scenarios to run; default is %(default)s')
+    parser.add_argument('-n','--num-tweets',dest='num_tweets',type=int,default=20000,
+            help='number of tweets in each scenario; default is %(default)s')
+    parser.add_argument('-d','--time-span',dest='time_span',type=int,default=86400,
+            help='seconds spanned by the tweets; default is %(default)s')
+    parser.add_argument('--retweet-ratio',dest='retweet_ratio',type=float,default=0.3,
+            help='fraction of tweets that are retweets; default is %(default)s')
+    parser.add_argument('--payload-size',dest='payload_size',type=int,default=2000,
+            help='approximate size in bytes of each tweet; default is %(default)s')
+    parser.add_argument('-w','--workers',dest='workers',type=int,nargs='+',default=[1,2,4],
+            help='values of n_workers for the enrichment scenarios; default is %(default)s')
+    parser.add_argument('--enrichment-work',dest='enrichment_work',type=int,default=1000,
+            help='loop iterations of CPU work per tweet in the enrichment; default is %(default)s')
+    parser.add_argument('--enrichment-sleep',dest='enrichment_sleep',type=float,default=0.,
+            help='seconds that the enrichment sleeps per tweet; default is %(default)s')
+    parser.add_argument('-b','--batch-size',dest='batch_size',type=int,default=1,
+            help='enricher batch size (-b); default is %(default)s')
+    parser.add_argument('--bucket-sizes',dest='bucket_sizes',nargs='+',default=['second','minute','hour','day'],
+            help='bucket sizes for the aggregation scenarios; default is %(default)s')
+    parser.add_argument('-m','--measurements',dest='measurements',type=int,nargs='+',default=[1,10,100,500],
+            help='numbers of measurements for the aggregation scenarios; default is %(default)s')
+    parser.add_argument('-f','--files',dest='files',type=int,nargs='+',default=[1,4],
+            help='numbers of input files for the aggregation scenarios; default is %(default)s')
+    parser.add_argument('-p','--num-cpu',dest='num_cpu',type=int,default=mp.cpu_count(),
+            help='builder processes (-p) for the aggregation scenarios; default is %(default)s')
+    parser.add_argument('-r','--repeat',dest='repeat',type=int,default=3,
+            help='runs of each scenario, of which the fastest is reported; default is %(default)s')
+    parser.add_argument('-o','--output-file',dest='output_file',default=None,
+            help='JSON results file; default is stdout')
+    parser.add_argument('--baseline',dest='baseline',default=None,
+            help='JSON results file of a previous run, to compare against')
+    args = parser.parse_args()
+
+    start_time = datetime.datetime(2016,6,16)
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if 'enrich' in args.scenarios:
+            input_file_name = os.path.join(tmp_dir,'tweets.json')
+            write_tweet_files([input_file_name],args.num_tweets,start_time,args.time_span,
+                    retweet_ratio=args.retweet_ratio,payload_size=args.payload_size)
+            results.extend(run_enrichment_scenarios(args,tmp_dir,input_file_name))
+        if 'aggregate' in args.scenarios:
+            results.extend(run_aggregation_scenarios(args,tmp_dir,start_time))
+
+    output = {'metadata':{'time':datetime.datetime.utcnow().isoformat(),
+                'git_commit':get_git_commit(),
+                'python':platform.python_version(),
+                'platform':platform.platform(),
+                'cpu_count':mp.cpu_count(),
+                'arguments':vars(args)},
+            'results':results}
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            compare_results(results,json.load(f)['results'])
+    if args.output_file is None:
+        print(json.dumps(output,indent=2))
+    else:
+        with open(args.output_file,'w') as f:
+            json.dump(output,f,indent=2)
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+"""
+Microbenchmark of the queues used to pass tweets between the 
+process-based enrichment workers of tweet_enricher.py: 
+'multiprocessing.JoinableQueue' versus the shared memory ring buffer.
+
+Each trial runs one enrichment stage of 'n_workers' processes that
+forward every batch unchanged, so the measured rate is the transport cost.
+"""
+
+import argparse
+import json
+import multiprocessing as mp
+import os
+import sys
+import time
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+from tweet_enricher import SharedMemoryQueue
+
+def forward(input_q,output_q):
+    while True:
+        batch = input_q.get()
+        if batch is None:
+            input_q.task_done()
+            break
+        output_q.put(batch)
+        input_q.task_done()
+
+def drain(input_q,n_batches):
+    for _ in range(n_batches):
+        input_q.get()
+
+def run_trial(queue_factory,tweets,n_workers,batch_size):
+    input_q = queue_factory(n_workers*2 + 1)
+    output_q = queue_factory(n_workers*2 + 1)
+    batches = [tweets[i:i+batch_size] for i in range(0,len(tweets),batch_size)]
+
+    workers = [mp.Process(target=forward,args=(input_q,output_q)) for _ in range(n_workers)]
+    consumer = mp.Process(target=drain,args=(output_q,len(batches)))
+    [worker.start() for worker in workers]
+    consumer.start()
+
+    start = time.perf_counter()
+    for batch in batches:
+        input_q.put(batch)
+    consumer.join()
+    elapsed = time.perf_counter() - start
+
+    for _ in workers:
+        input_q.put(None)
+    [worker.join() for worker in workers]
+    for q in (input_q,output_q):
+        if isinstance(q,SharedMemoryQueue):
+            q.close()
+    return elapsed
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('-i','--input-file',dest='input_file',
+            default=os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','example','dummy_tweets.json'),
+            help='file of JSON tweets to pass through the queues; default is %(default)s')
+    parser.add_argument('-n','--num-tweets',dest='num_tweets',type=int,default=20000,
+            help='number of tweets per trial; default is %(default)s')
+    parser.add_argument('-w','--workers',dest='workers',type=int,nargs='+',default=[1,2,4,8],
+            help='values of n_workers to benchmark; default is %(default)s')
+    parser.add_argument('-b','--batch-size',dest='batch_size',type=int,default=1,
+            help='tweets per queue item; default is %(default)s')
+    parser.add_argument('--ring-buffer-size',dest='ring_buffer_size',type=float,default=8,
+            help='size in MB of each shared memory ring buffer; default is %(default)s')
+    args = parser.parse_args()
+
+    with open(args.input_file) as f:
+        sample = [json.loads(line) for line in f]
+    tweets = [sample[i % len(sample)] for i in range(args.num_tweets)]
+
+    transports = [('JoinableQueue',mp.JoinableQueue),
+            ('SharedMemoryQueue',lambda maxsize: SharedMemoryQueue(int(args.ring_buffer_size*2**20)))]
+    
+    print('transport,n_workers,batch_size,seconds,tweets_per_second')
+    for n_workers in args.workers:
+        for name,queue_factory in transports:
+            elapsed = run_trial(queue_factory,tweets,n_workers,args.batch_size)
+            print(f'{name},{n_workers},{args.batch_size},{elapsed:.3f},{len(tweets)/elapsed:.0f}')
@@ -0,0 +1,59 @@
+import asyncio
+import json
+import os
+from urllib.parse import urlsplit
+
+class RemoteLengthEnrichment(object):
+    """
+    This dummy asynchronous enrichment posts the Tweet body to an HTTP service
+    (at the URL in the MODEL_URL environment variable) and assigns the JSON
+    response to a 'RemoteLengthEnrichment' key in the 'enrichments' dictionary.
+
+    Idle keep-alive connections are kept in a pool that is created in 'open',
+    so connections are reused across requests, and closed in 'close'.
+    """
+    max_in_flight = 50
+    request_timeout = 5
+
+    async def open(self):
+        url = urlsplit(os.environ.get('MODEL_URL','http://localhost:8000/'))
+        self.host, self.port, self.path = url.hostname, url.port or 80, url.path or '/'
+        self.idle_connections = []
+
+    async def request(self,body):
+        if self.idle_connections:
+            reader, writer = self.idle_connections.pop()
+        else:
+            reader, writer = await asyncio.open_connection(self.host,self.port)
+        try:
+            writer.write('POST {} HTTP/1.1\r\nHost: {}\r\nContent-Length: {}\r\n\r\n'.format(
+                self.path,self.host,len(body)).encode('ascii') + body)
+            await writer.drain()
+            await reader.readline() # status line
+            content_length = 0
+            while True:
+                header = await reader.readline()
+                if header in (b'\r\n',b''):
+                    break
+                name, _, value = header.decode('latin1').partition(':')
+                if name.strip().lower() == 'content-length':
+                    content_length = int(value)
+            response = await reader.readexactly(content_length)
+        except BaseException:
+            # don't reuse a connection left in an unknown state, e.g. after a timeout
+            writer.close()
+            raise
+        self.idle_connections.append((reader,writer))
+        return response
+
+    async def enrich(self,tweet):
+        response = await self.request(tweet['body'].encode('utf8'))
+        if 'enrichments' not in tweet:
+            tweet['enrichments'] = {}
+        tweet['enrichments'][self.__class__.__name__] = json.loads(response)
+
+    async def close(self):
+        for _,writer in self.idle_connections:
+            writer.close()
+
+enrichment_class_list = [(RemoteLengthEnrichment,1)]
@@ -1,21 +1,25 @@
 class TweetCounter(object):
+    """ a counter, whose counts for all time buckets are kept in one array """
+    # top-level Tweet fields used by this measurement
+    fields = ()
     def __init__(self, **kwargs):
-        self.counter = 0
-    def add_tweet(self,tweet):
-        self.counter += 1
-    def get(self):
-        return [(self.counter,self.get_name())]
+        pass
+    def count(self,tweet):
+        return 1
+    def count_batch(self,columns):
+        return len(columns['bucket'])
     def get_name(self):
         return 'TweetCounter'
-    def combine(self,new):
-        self.counter += new.counter
 
 class ReTweetCounter(object):
+    fields = ('verb',)
     def __init__(self, **kwargs):
         self.counter = 0
     def add_tweet(self,tweet):
         if tweet['verb'] == 'share':
             self.counter += 1
+    def add_batch(self,columns):
+        self.counter += int((columns['verb'] == 'share').sum())
     def get(self):
         return [(self.counter,self.get_name())]
     def get_name(self):
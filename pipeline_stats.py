@@ -0,0 +1,205 @@
+"""
+Instrumentation shared by the Tweet enricher and the time series builder:
+latency histograms, counters and sampled gauges kept for each process and
+written periodically as JSON lines, and hooks for profiling workers with cProfile.
+"""
+import os
+import sys
+import time
+import json
+import threading
+import cProfile
+import multiprocessing.util
+
+class LatencyHistogram(object):
+    """
+    Counts durations in power-of-two buckets of microseconds, so that
+    percentiles are reported to within a factor of two
+    """
+    N_BUCKETS = 40
+
+    def __init__(self):
+        self.counts = [0]*self.N_BUCKETS
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+
+    def add(self,seconds):
+        self.counts[min(int(seconds*1e6).bit_length(),self.N_BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def get_percentile(self,fraction):
+        """ return the upper bound, in seconds, of the bucket holding a percentile """
+        threshold = fraction*self.count
+        cumulative_count = 0
+        for bucket,count in enumerate(self.counts):
+            cumulative_count += count
+            if cumulative_count >= threshold:
+                return min(2**bucket/1e6,self.max)
+        return self.max
+
+    def get_stats(self,elapsed):
+        """ summarize the histogram; 'busy_fraction' is the total duration over 'elapsed' seconds """
+        return {'count':self.count,
+                'total_s':round(self.total,6),
+                'busy_fraction':round(self.total/elapsed,4) if elapsed > 0 else None,
+                'mean_ms':round(1e3*self.total/self.count,4) if self.count > 0 else None,
+                'p50_ms':round(1e3*self.get_percentile(0.5),4),
+                'p90_ms':round(1e3*self.get_percentile(0.9),4),
+                'p99_ms':round(1e3*self.get_percentile(0.99),4),
+                'max_ms':round(1e3*self.max,4)}
+
+class Stats(object):
+    """
+    Latency histograms, counters and gauges for one process.
+
+    Once 'start' is called in a process, a thread samples the gauges (functions
+    returning a number, such as a queue size) every second, and every 'interval'
+    seconds writes a JSON line with the time, the process label and id, the
+    histograms and counters since the process started, and the last, mean and
+    maximum value of each gauge. Lines are appended to 'file_name', or written
+    to stderr if it's '-'. A final line is written when the process exits.
+
+    A forked worker process calls 'start' to begin reporting its own stats,
+    discarding any inherited from its parent; in a process that is already
+    reporting, 'start' does nothing.
+    """
+    def __init__(self,file_name,interval):
+        self.file_name = file_name
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.pid = None
+        self.stopped = threading.Event()
+
+    def _reset(self):
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+        self.gauge_samples = {}
+        self.start_time = time.time()
+
+    def start(self,label):
+        if self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        self.label = label
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self._reset()
+        self.thread = threading.Thread(target=self._report,daemon=True)
+        self.thread.start()
+        multiprocessing.util.Finalize(self,self.stop,exitpriority=5)
+
+    def add_time(self,name,seconds):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = LatencyHistogram()
+            histogram.add(seconds)
+
+    def count(self,name,n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name,0) + n
+
+    def add_gauge(self,name,func):
+        with self.lock:
+            self.gauges[name] = func
+            self.gauge_samples[name] = []
+
+    def _sample_gauges(self):
+        for name,func in list(self.gauges.items()):
+            try:
+                value = func()
+            except (NotImplementedError,OSError,ValueError):
+                continue
+            with self.lock:
+                self.gauge_samples[name].append(value)
+
+    def get_snapshot(self):
+        now = time.time()
+        elapsed = now - self.start_time
+        with self.lock:
+            gauges = {name:{'last':samples[-1],'mean':round(sum(samples)/float(len(samples)),3),'max':max(samples)}
+                    for name,samples in self.gauge_samples.items() if len(samples) > 0}
+            for samples in self.gauge_samples.values():
+                del samples[:]
+            return {'time':round(now,3),
+                    'label':self.label,
+                    'pid':self.pid,
+                    'elapsed_s':round(elapsed,3),
+                    'histograms':{name:histogram.get_stats(elapsed) for name,histogram in self.histograms.items()},
+                    'counters':dict(self.counters),
+                    'gauges':gauges}
+
+    def write_line(self):
+        line = json.dumps(self.get_snapshot(),sort_keys=True) + '\n'
+        if self.file_name == '-':
+            sys.stderr.write(line)
+            sys.stderr.flush()
+        else:
+            # each line is appended with one write, so lines from several processes don't interleave
+            with open(self.file_name,'a') as f:
+                f.write(line)
+
+    def _report(self):
+        next_report = time.time() + self.interval
+        while not self.stopped.wait(min(1.,self.interval)):
+            self._sample_gauges()
+            if time.time() >= next_report:
+                self.write_line()
+                next_report += self.interval
+
+    def stop(self):
+        """ stop reporting, and write the final stats line of this process """
+        if self.pid != os.getpid() or self.stopped.is_set():
+            return
+        self.stopped.set()
+        self._sample_gauges()
+        self.write_line()
+
+def get_profile_file_name(profile_dir,label):
+    return os.path.join(profile_dir,'{}-{}.prof'.format(label,os.getpid()))
+
+# the profiler started by 'start_profiling', and the process it was started in
+active_profiler = None
+active_profiler_pid = None
+
+def disable_inherited_profiler():
+    """ a process forked from a profiled thread inherits its profiler, which must be disabled first """
+    if active_profiler is not None and active_profiler_pid != os.getpid():
+        active_profiler.disable()
+
+def start_profiling(profile_dir,label):
+    """ profile the calling thread until the process exits, and then write the profile to 'profile_dir' """
+    global active_profiler, active_profiler_pid
+    disable_inherited_profiler()
+    os.makedirs(profile_dir,exist_ok=True)
+    profiler = cProfile.Profile()
+    profiler.enable()
+    active_profiler, active_profiler_pid = profiler, os.getpid()
+    def write_profile():
+        profiler.disable()
+        profiler.dump_stats(get_profile_file_name(profile_dir,label))
+    multiprocessing.util.Finalize(None,write_profile,exitpriority=10)
+
+def profile_target(profile_dir,label,target):
+    """ wrap a worker thread or process target, so that it runs with its own profiler """
+    def profiled_target(*args):
+        disable_inherited_profiler()
+        os.makedirs(profile_dir,exist_ok=True)
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(target,*args)
+        finally:
+            profiler.dump_stats(get_profile_file_name(profile_dir,label))
+    return profiled_target
+
+def start_instrumentation(stats,profile_dir,label):
+    """ start reporting stats (if 'stats' isn't None) and profiling (if 'profile_dir' isn't None) in a process """
+    if stats is not None:
+        stats.start(label)
+    if profile_dir is not None:
+        start_profiling(profile_dir,label)
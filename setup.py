@@ -4,6 +4,7 @@ setup(name='gnip_analysis_pipeline',
         scripts=['tweet_enricher.py', 
             'tweet_time_series_builder.py', 
             ],
+        py_modules=['sketch_measurements','pipeline_stats','tweet_io'],
         version='1.1',
         license='MIT',
         author='Jeff Kolb',
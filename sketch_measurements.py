@@ -0,0 +1,204 @@
+"""
+Probabilistic measurements with fixed memory and fast merges, for use in
+the 'measurement_class_list' of a time series builder config file.
+
+Each sketch class implements 'add_tweet', 'get', 'get_name' and 'combine',
+and is subclassed to define 'get_values(tweet)', which returns the values
+of a Tweet to add to the sketch. A measurement's name is its class name.
+Sketches are pickled as their raw counters.
+
+Accuracy parameters are set with 'config_kwargs':
+
+* 'hll_precision' - HyperLogLog index bits, for 2**precision one-byte
+  registers and a relative error of about 1.04/sqrt(2**precision); default is 12
+* 'count_min_width', 'count_min_depth' - Count-Min table size; estimates
+  exceed true counts by at most about e/width of the total count, with
+  probability 1 - exp(-depth); defaults are 2048 and 4
+* 'top_k' - number of values reported by Count-Min and Space-Saving
+  measurements; default is 10
+* 'top_k_capacity' - number of values tracked by Count-Min and Space-Saving
+  measurements; default is 100
+"""
+import array
+import hashlib
+import heapq
+import math
+import operator
+
+def hash64(value):
+    """ a 64-bit hash of a value's string form that, unlike 'hash', is the same in every process """
+    return int.from_bytes(hashlib.blake2b(str(value).encode('utf8'),digest_size=8).digest(),'little')
+
+class SketchMeasurement(object):
+    """ base class for sketch measurements """
+    def get_values(self,tweet):
+        raise NotImplementedError
+    def add_tweet(self,tweet):
+        for value in self.get_values(tweet):
+            self.add_value(value)
+    def get_name(self):
+        return self.__class__.__name__
+
+class HyperLogLogMeasurement(SketchMeasurement):
+    """ estimates the number of distinct values """
+    def __init__(self, **kwargs):
+        self.precision = kwargs.get('hll_precision',12)
+        self.registers = bytearray(2**self.precision)
+    def add_value(self,value):
+        h = hash64(value)
+        index = h >> (64 - self.precision)
+        # the position of the first 1 bit in the remaining bits
+        rank = 64 - self.precision - (h & ((1 << (64 - self.precision)) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+    def estimate(self):
+        m = len(self.registers)
+        alpha = 0.7213/(1 + 1.079/m)
+        raw_estimate = alpha*m*m/sum(2.0**-register for register in self.registers)
+        n_zeros = self.registers.count(0)
+        if raw_estimate <= 2.5*m and n_zeros > 0:
+            # linear counting, for small cardinalities
+            return m*math.log(m/float(n_zeros))
+        return raw_estimate
+    def get(self):
+        return [(int(round(self.estimate())),self.get_name())]
+    def combine(self,new):
+        self.registers = bytearray(map(max,self.registers,new.registers))
+    def __getstate__(self):
+        return bytes(self.registers)
+    def __setstate__(self,state):
+        self.registers = bytearray(state)
+        self.precision = len(self.registers).bit_length() - 1
+
+class TopValuesMeasurement(SketchMeasurement):
+    """ base class for measurements reporting the counts of the 'top_k' most frequent values """
+    def __init__(self, **kwargs):
+        self.top_k = kwargs.get('top_k',10)
+        self.capacity = max(self.top_k,kwargs.get('top_k_capacity',100))
+    def get_top_counts(self):
+        """ return the tracked (value, count) pairs """
+        raise NotImplementedError
+    def get(self):
+        top_counts = heapq.nlargest(self.top_k,self.get_top_counts(),key=lambda item: (item[1],item[0]))
+        return [(count,'{}_{}'.format(self.get_name(),value)) for value,count in top_counts]
+
+class CountMinMeasurement(TopValuesMeasurement):
+    """
+    estimates value frequencies with a Count-Min sketch, and reports the
+    estimated counts of the most frequent values it has seen
+    """
+    def __init__(self, **kwargs):
+        super(CountMinMeasurement,self).__init__(**kwargs)
+        self.width = kwargs.get('count_min_width',2048)
+        self.depth = kwargs.get('count_min_depth',4)
+        self.table = array.array('q',[0])*(self.width*self.depth)
+        self.candidates = {}
+    def _get_indices(self,value):
+        # double hashing gives the column of each row
+        h = hash64(value)
+        h1, h2 = h & 0xffffffff, h >> 32
+        return [row*self.width + (h1 + row*h2) % self.width for row in range(self.depth)]
+    def add_value(self,value):
+        value = str(value)
+        table = self.table
+        indices = self._get_indices(value)
+        for index in indices:
+            table[index] += 1
+        self.candidates[value] = min(table[index] for index in indices)
+        if len(self.candidates) > 2*self.capacity:
+            self._prune_candidates()
+    def _prune_candidates(self):
+        self.candidates = dict(heapq.nlargest(self.capacity,self.candidates.items(),key=operator.itemgetter(1)))
+    def estimate(self,value):
+        return min(self.table[index] for index in self._get_indices(str(value)))
+    def get_top_counts(self):
+        return [(value,self.estimate(value)) for value in self.candidates]
+    def combine(self,new):
+        self.table = array.array('q',map(operator.add,self.table,new.table))
+        self.candidates = {value:self.estimate(value) for value in set(self.candidates) | set(new.candidates)}
+        self._prune_candidates()
+    def __getstate__(self):
+        return (self.top_k,self.capacity,self.width,self.depth,self.table.tobytes(),self.candidates)
+    def __setstate__(self,state):
+        self.top_k,self.capacity,self.width,self.depth,table_bytes,self.candidates = state
+        self.table = array.array('q')
+        self.table.frombytes(table_bytes)
+
+class SpaceSavingMeasurement(TopValuesMeasurement):
+    """
+    finds the most frequent values with the Space-Saving algorithm, which
+    tracks 'top_k_capacity' values and overestimates their counts by at most
+    the smallest tracked count
+    """
+    def __init__(self, **kwargs):
+        super(SpaceSavingMeasurement,self).__init__(**kwargs)
+        self.counts = {}
+        # one (count, value) entry for each tracked value, with a count that may lag behind 'counts'
+        self.heap = []
+    def add_value(self,value):
+        value = str(value)
+        count = self.counts.get(value)
+        if count is not None:
+            self.counts[value] = count + 1
+            return
+        if len(self.counts) < self.capacity:
+            count = 0
+        else:
+            count, replaced_value = self._pop_min()
+            del self.counts[replaced_value]
+        self.counts[value] = count + 1
+        heapq.heappush(self.heap,(count + 1,value))
+    def _pop_min(self):
+        while True:
+            count, value = heapq.heappop(self.heap)
+            current_count = self.counts[value]
+            if current_count == count:
+                return count, value
+            heapq.heappush(self.heap,(current_count,value))
+    def get_top_counts(self):
+        return self.counts.items()
+    def combine(self,new):
+        # a value missing from a full summary may have had up to its smallest count
+        min_count = min(self.counts.values()) if len(self.counts) >= self.capacity else 0
+        new_min_count = min(new.counts.values()) if len(new.counts) >= new.capacity else 0
+        counts = {value:self.counts.get(value,min_count) + new.counts.get(value,new_min_count)
+                for value in set(self.counts) | set(new.counts)}
+        self.counts = dict(heapq.nlargest(self.capacity,counts.items(),key=lambda item: (item[1],item[0])))
+        self.heap = [(count,value) for value,count in self.counts.items()]
+        heapq.heapify(self.heap)
+    def __getstate__(self):
+        return (self.top_k,self.capacity,self.counts)
+    def __setstate__(self,state):
+        self.top_k,self.capacity,self.counts = state
+        self.heap = [(count,value) for value,count in self.counts.items()]
+        heapq.heapify(self.heap)
+
+def get_hashtags(tweet):
+    entities = tweet.get('twitter_entities') or {}
+    return [hashtag['text'].lower() for hashtag in entities.get('hashtags',[])]
+
+def get_mentions(tweet):
+    entities = tweet.get('twitter_entities') or {}
+    return [mention['screen_name'].lower() for mention in entities.get('user_mentions',[])]
+
+class DistinctActors(HyperLogLogMeasurement):
+    """ estimated number of distinct Tweet authors """
+    fields = ('actor',)
+    def get_values(self,tweet):
+        actor = tweet.get('actor')
+        return [actor['id']] if actor else []
+
+class TopHashtags(SpaceSavingMeasurement):
+    fields = ('twitter_entities',)
+    def get_values(self,tweet):
+        return get_hashtags(tweet)
+
+class TopMentions(SpaceSavingMeasurement):
+    fields = ('twitter_entities',)
+    def get_values(self,tweet):
+        return get_mentions(tweet)
+
+class HashtagFrequencies(CountMinMeasurement):
+    fields = ('twitter_entities',)
+    def get_values(self,tweet):
+        return get_hashtags(tweet)
@@ -0,0 +1,64 @@
+import unittest
+import sys
+import os
+import pickle
+import random
+import collections
+import itertools
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import sketch_measurements
+
+def make_tweet(actor_id,hashtags):
+    return {'actor':{'id':'id:twitter.com:{}'.format(actor_id)},
+            'twitter_entities':{'hashtags':[{'text':hashtag} for hashtag in hashtags],'user_mentions':[]}}
+
+class SketchTests(unittest.TestCase):
+    """Tests for the sketch measurements"""
+    def setUp(self):
+        rng = random.Random(42)
+        # hashtag frequencies fall off as 1/rank
+        hashtags = ['tag{}'.format(rank) for rank in range(1,1001)]
+        cum_weights = list(itertools.accumulate(1.0/rank for rank in range(1,1001)))
+        self.tweets = [make_tweet(rng.randrange(20000),rng.choices(hashtags,cum_weights=cum_weights,k=2)) for _ in range(40000)]
+        self.true_counts = collections.Counter(hashtag['text'] for tweet in self.tweets
+                for hashtag in tweet['twitter_entities']['hashtags'])
+        self.n_actors = len(set(tweet['actor']['id'] for tweet in self.tweets))
+
+    def aggregate(self,measurement_class,**kwargs):
+        """ add halves of the tweets to two instances, and combine them after pickling """
+        measurements = []
+        for tweets in [self.tweets[:len(self.tweets)//2],self.tweets[len(self.tweets)//2:]]:
+            measurement = measurement_class(**kwargs)
+            for tweet in tweets:
+                measurement.add_tweet(tweet)
+            measurements.append(pickle.loads(pickle.dumps(measurement)))
+        measurements[0].combine(measurements[1])
+        return measurements[0]
+
+    def test_hyperloglog(self):
+        measurement = self.aggregate(sketch_measurements.DistinctActors)
+        [(estimate,name)] = measurement.get()
+        self.assertEqual(name,'DistinctActors')
+        self.assertLess(abs(estimate - self.n_actors),0.05*self.n_actors)
+        self.assertLess(len(pickle.dumps(measurement)),2**12 + 200)
+
+    def test_count_min(self):
+        measurement = self.aggregate(sketch_measurements.HashtagFrequencies,top_k=5)
+        for hashtag,count in self.true_counts.most_common(50):
+            self.assertGreaterEqual(measurement.estimate(hashtag),count)
+        expected = ['HashtagFrequencies_' + hashtag for hashtag,_ in self.true_counts.most_common(5)]
+        self.assertEqual([name for _,name in measurement.get()],expected)
+
+    def test_space_saving(self):
+        measurement = self.aggregate(sketch_measurements.TopHashtags,top_k=5,top_k_capacity=200)
+        top_counts = measurement.get()
+        expected = ['TopHashtags_' + hashtag for hashtag,_ in self.true_counts.most_common(5)]
+        self.assertEqual([name for _,name in top_counts],expected)
+        for count,name in top_counts:
+            true_count = self.true_counts[name[len('TopHashtags_'):]]
+            self.assertGreaterEqual(count,true_count)
+            self.assertLess(count,true_count*1.1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,17 @@
 import unittest
 import subprocess
 import json
+import sys
+import os
+import tempfile
+import re
+import collections
+import multiprocessing
+import threading
+import http.server
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import tweet_enricher
 
 class TestEnrichment(object):
     def enrich(self,tweet):
@@ -9,6 +20,86 @@ class TestEnrichment(object):
         tweet['enrichments'][self.__class__.__name__] = 1
 
 INPUT_FILE_NAME = 'dummy_tweets.json'
+ENRICHER_SCRIPT = 'tweet_enricher.py'
+ENRICHER_CONFIG = 'example/my_enrichments.py'
+
+ASYNC_ENRICHER_CONFIG = 'example/my_async_enrichments.py'
+
+class StubModelHandler(http.server.BaseHTTPRequestHandler):
+    """ keep-alive HTTP handler that responds with the length of the posted body """
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    def setup(self):
+        super().setup()
+        self.server.n_connections += 1
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        response = json.dumps(len(body)).encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-Length',str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+    def log_message(self,*args):
+        pass
+
+class FailingModelHandler(http.server.BaseHTTPRequestHandler):
+    """ handler that drops each connection without a response """
+    def do_POST(self):
+        self.close_connection = True
+    def log_message(self,*args):
+        pass
+
+class StubModelServer(http.server.ThreadingHTTPServer):
+    """ accept the burst of connections opened by the asynchronous enrichment """
+    request_queue_size = 128
+
+def run_enricher(options,config=ENRICHER_CONFIG,env=None,stderr=None):
+    """ run the enricher script over the test tweets and return the parsed output """
+    with open(INPUT_FILE_NAME) as input_file:
+        out = subprocess.check_output([sys.executable,ENRICHER_SCRIPT,'-c',config] + options,
+                stdin=input_file,env=env,stderr=stderr,timeout=120)
+    return [json.loads(line) for line in out.decode('utf8').splitlines()]
+
+def write_config(dir_name,source):
+    """ write a config file of enrichment classes to a directory, and return its name """
+    config = os.path.join(dir_name,'test_enrichments.py')
+    with open(config,'w') as f:
+        f.write(source)
+    return config
+
+# a stage of several workers that take random times, so that batches finish out of order
+RANDOM_DELAY_CONFIG = """
+import random
+import time
+class RandomDelayEnrichment(object):
+    def enrich(self,tweet):
+        time.sleep(random.random()*0.01)
+        tweet.setdefault('enrichments',{})['RandomDelayEnrichment'] = 1
+enrichment_class_list = [(RandomDelayEnrichment,4)]
+"""
+
+# an enrichment without 'enrich', so that a run fails if 'enrich' is called
+BATCH_ONLY_CONFIG = """
+class BatchOnlyEnrichment(object):
+    def enrich_batch(self,tweets):
+        for tweet in tweets:
+            tweet.setdefault('enrichments',{})['BatchOnlyEnrichment'] = len(tweets)
+enrichment_class_list = [(BatchOnlyEnrichment,1)]
+"""
+
+# enrichments that record the run that called them, cached by tweet id (with a version) and by body
+CACHED_CONFIG = """
+import os
+class IdEnrichment(object):
+    version = os.environ['CACHE_TEST_VERSION']
+    def enrich(self,tweet):
+        tweet.setdefault('enrichments',{})['IdEnrichment'] = os.environ['CACHE_TEST_RUN']
+class BodyEnrichment(object):
+    cache_key = 'body'
+    def enrich(self,tweet):
+        tweet.setdefault('enrichments',{})['BodyEnrichment'] = os.environ['CACHE_TEST_RUN']
+enrichment_class_list = [(IdEnrichment,1),(BodyEnrichment,1)]
+"""
 
 class AnalysisTests(unittest.TestCase):
     """Tests for functions in tweet_enricher.py"""
@@ -44,6 +135,247 @@ class AnalysisTests(unittest.TestCase):
             enriched_tweets.append(tweet)
         self.assertTrue(all(tweet['enrichments']['TestEnrichment']==1 for tweet in enriched_tweets))
 
+    def test_enrich_tweets(self):
+        """ check the enrichment chain when the module is imported """
+        class BatchEnrichment(TestEnrichment):
+            def enrich_batch(self,tweets):
+                return [dict(tweet,enrichments={'BatchEnrichment':len(tweets)}) for tweet in tweets]
+        tweets = tweet_enricher.enrich_tweets([BatchEnrichment(),TestEnrichment()],[dict(tweet) for tweet in self.tweets[:5]])
+        self.assertEqual([tweet['id'] for tweet in tweets],[tweet['id'] for tweet in self.tweets[:5]])
+        self.assertTrue(all(tweet['enrichments'] == {'BatchEnrichment':5,'TestEnrichment':1} for tweet in tweets))
+
+    def test_concurrent_modes(self):
+        """ check that the architecture and transport options all enrich every tweet, in order """
+        for options in [[],['-s'],['-s','-b','50'],['-p'],['-b','50'],['-p','-r'],['-p','-r','-b','50'],['-n','3','--shard-chunk-size','50'],
+                ['-p','-b','5','--preserve-order'],['-b','20','--cache'],
+                ['-p','-b','5','-a','--autoscale-interval','0.1','--max-workers','3','--preserve-order']]:
+            enriched_tweets = run_enricher(options)
+            self.assertEqual([tweet['id'] for tweet in enriched_tweets],[tweet['id'] for tweet in self.tweets])
+            self.assertTrue(all(tweet['enrichments']['TestEnrichment']==1 for tweet in enriched_tweets))
+
+    def test_batch_enrichment(self):
+        """ check that an enrichment with only 'enrich_batch' gets every tweet, in batches of the expected sizes """
+        # full batches of 50, and the remainder; the long timeout keeps partial batches from being passed on early
+        expected_sizes = collections.Counter({50:len(self.tweets) - len(self.tweets) % 50,len(self.tweets) % 50:len(self.tweets) % 50})
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            config = write_config(tmp_dir,BATCH_ONLY_CONFIG)
+            for options in [['-s','-b','50','-t','60'],['-b','50','-t','60'],['-p','-b','50','-t','60'],
+                    ['-n','2','--shard-chunk-size','50']]:
+                enriched_tweets = run_enricher(options,config=config)
+                self.assertEqual([tweet['id'] for tweet in enriched_tweets],[tweet['id'] for tweet in self.tweets])
+                self.assertEqual(collections.Counter(tweet['enrichments']['BatchOnlyEnrichment'] for tweet in enriched_tweets),
+                        expected_sizes)
+
+    def test_enrichment_cache(self):
+        """ check memory hits, persistence in a cache file across runs, and invalidation by version """
+        n_ids = len(set(tweet['id'] for tweet in self.tweets))
+        n_bodies = len(set(tweet['body'] for tweet in self.tweets))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            config = write_config(tmp_dir,CACHED_CONFIG)
+            cache_file = os.path.join(tmp_dir,'cache.db')
+            def run(run_id,version):
+                env = dict(os.environ,CACHE_TEST_RUN=run_id,CACHE_TEST_VERSION=version)
+                with open(INPUT_FILE_NAME) as input_file:
+                    process = subprocess.run([sys.executable,ENRICHER_SCRIPT,'-c',config,'--cache-file',cache_file],
+                            stdin=input_file,env=env,stdout=subprocess.PIPE,stderr=subprocess.PIPE,check=True,timeout=120)
+                enriched_tweets = [json.loads(line) for line in process.stdout.decode('utf8').splitlines()]
+                self.assertEqual(len(enriched_tweets),len(self.tweets))
+                values = {name:set(tweet['enrichments'][name] for tweet in enriched_tweets) for name in ['IdEnrichment','BodyEnrichment']}
+                counts = {name:tuple(int(count) for count in re.search(name + r' cache: (\d+) memory hits, (\d+) disk hits, (\d+) misses',
+                    process.stderr.decode('utf8')).groups()) for name in values}
+                return values, counts
+            # repeated ids and bodies hit the memory cache
+            values, counts = run('1','1')
+            self.assertEqual(values,{'IdEnrichment':{'1'},'BodyEnrichment':{'1'}})
+            self.assertEqual(counts,{'IdEnrichment':(len(self.tweets) - n_ids,0,n_ids),
+                'BodyEnrichment':(len(self.tweets) - n_bodies,0,n_bodies)})
+            # the second run takes every result from the cache file, without calling the enrichments
+            values, counts = run('2','1')
+            self.assertEqual(values,{'IdEnrichment':{'1'},'BodyEnrichment':{'1'}})
+            self.assertEqual(counts,{'IdEnrichment':(len(self.tweets) - n_ids,n_ids,0),
+                'BodyEnrichment':(len(self.tweets) - n_bodies,n_bodies,0)})
+            # a new version of an enrichment misses its old results
+            values, counts = run('3','2')
+            self.assertEqual(values,{'IdEnrichment':{'3'},'BodyEnrichment':{'1'}})
+            self.assertEqual(counts['IdEnrichment'],(len(self.tweets) - n_ids,0,n_ids))
+
+    def test_preserve_order(self):
+        """ check that the reorder buffer restores the input order of batches from several workers """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            config = write_config(tmp_dir,RANDOM_DELAY_CONFIG)
+            for options in [[],['-p'],['--reorder-policy','flush','--reorder-window','1000']]:
+                with open(INPUT_FILE_NAME) as input_file:
+                    process = subprocess.run([sys.executable,ENRICHER_SCRIPT,'-c',config,'-b','5','--preserve-order','-v'] + options,
+                            stdin=input_file,stdout=subprocess.PIPE,stderr=subprocess.PIPE,check=True,timeout=120)
+                enriched_tweets = [json.loads(line) for line in process.stdout.decode('utf8').splitlines()]
+                self.assertEqual([tweet['id'] for tweet in enriched_tweets],[tweet['id'] for tweet in self.tweets])
+                # some batches arrived early and were held
+                n_held = int(re.search(r'reorder buffer held (\d+) batches',process.stderr.decode('utf8')).group(1))
+                self.assertGreater(n_held,0)
+
+    def test_reorder_buffer(self):
+        """ check the batches released by the reorder buffer under each policy """
+        reorder_buffer = tweet_enricher.ReorderBuffer(2,'block')
+        self.assertEqual(reorder_buffer.add(1,'b1'),[])
+        self.assertEqual(reorder_buffer.add(2,'b2'),[])
+        self.assertEqual(reorder_buffer.add(0,'b0'),['b0','b1','b2'])
+        self.assertEqual(reorder_buffer.add(4,'b4'),[])
+        self.assertEqual(reorder_buffer.drain(),['b4'])
+        self.assertEqual(reorder_buffer.n_out_of_order,0)
+        # the flush policy gives up on batch 0 when the window overflows, and writes it when it arrives
+        reorder_buffer = tweet_enricher.ReorderBuffer(2,'flush')
+        self.assertEqual(reorder_buffer.add(1,'b1'),[])
+        self.assertEqual(reorder_buffer.add(3,'b3'),[])
+        self.assertEqual(reorder_buffer.add(2,'b2'),['b1','b2','b3'])
+        self.assertEqual(reorder_buffer.add(0,'b0'),['b0'])
+        self.assertEqual(reorder_buffer.add(4,'b4'),['b4'])
+        self.assertEqual(reorder_buffer.n_out_of_order,1)
+        self.assertEqual(reorder_buffer.drain(),[])
+        self.assertIn('1 batches written out of order',reorder_buffer.get_stats())
+
+    def test_instrumentation(self):
+        """ check the JSON stats lines and profiles written by each process """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            stats_file = os.path.join(tmp_dir,'stats.jsonl')
+            profile_dir = os.path.join(tmp_dir,'profiles')
+            run_enricher(['-p','-b','10','--stats-file',stats_file,'--profile-dir',profile_dir])
+            with open(stats_file) as f:
+                last_lines = {stats['label']:stats for stats in map(json.loads,f)}
+            self.assertEqual(sorted(last_lines),['main','output','stage0-worker0'])
+            worker_histograms = last_lines['stage0-worker0']['histograms']
+            # one enrichment call for each batch
+            self.assertEqual(worker_histograms['enrichment.TestEnrichment']['count'],worker_histograms['stage0.worker0.busy']['count'])
+            self.assertGreaterEqual(worker_histograms['stage0.worker0.busy']['count'],len(self.tweets)//10)
+            self.assertEqual(last_lines['output']['counters']['output.tweets'],len(self.tweets))
+            self.assertIn('queue1.depth',last_lines['main']['gauges'])
+            self.assertEqual(len(os.listdir(profile_dir)),3)
+
+    def test_shared_memory_transport(self):
+        """ check the ring buffers with several workers, where batches wrap around and fill the rings """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            config = os.path.join(tmp_dir,'parallel_enrichments.py')
+            with open(config,'w') as f:
+                f.write('import sys\nsys.path.insert(0,{!r})\n'.format(os.path.abspath('example')))
+                f.write('from my_enrichments import TestEnrichment\nenrichment_class_list = [(TestEnrichment,3)]\n')
+            # with the smallest ring, batches of 10 don't fit and go through the overflow queues
+            for options in [['-b','5'],['-r','-b','5','--preserve-order'],['-b','10','--ring-buffer-size','0.01']]:
+                enriched_tweets = run_enricher(['-p','-m','--ring-buffer-size','0.25'] + options,config=config,stderr=subprocess.DEVNULL)
+                self.assertEqual(sorted(tweet['id'] for tweet in enriched_tweets),sorted(tweet['id'] for tweet in self.tweets))
+                self.assertTrue(all(tweet['enrichments']['TestEnrichment']==1 for tweet in enriched_tweets))
+
+    def test_shared_memory_queue(self):
+        """ check records passed through a ring buffer, including records that only fit in the overflow queue """
+        q = tweet_enricher.SharedMemoryQueue(1000)
+        try:
+            for i in range(10):
+                # each record wraps around the end of the ring at a different offset
+                q.put((i,'x'*300))
+                self.assertEqual(q.get(),(i,'x'*300))
+                q.task_done()
+            q.join()
+            # records too large for the ring go through the overflow queue
+            items = [(i,'x'*(2000 if i % 2 else 300)) for i in range(6)]
+            for item in items:
+                q.put(item)
+                self.assertEqual(q.get(),item)
+                q.task_done()
+            q.put('x'*1000)
+            self.assertEqual(q.qsize(),1)
+            self.assertEqual(q.get(),'x'*1000)
+            q.task_done()
+            q.join()
+            self.assertEqual(q.qsize(),0)
+        finally:
+            q.close()
+
+    def test_async_enrichment_errors(self):
+        """ check that tweets are passed on unenriched when the model server refuses or drops connections """
+        server = StubModelServer(('127.0.0.1',0),FailingModelHandler)
+        threading.Thread(target=server.serve_forever,daemon=True).start()
+        # nothing listens on the port of a closed server
+        closed_server = StubModelServer(('127.0.0.1',0),FailingModelHandler)
+        closed_server.server_close()
+        try:
+            for address in [server.server_address,closed_server.server_address]:
+                env = dict(os.environ,MODEL_URL='http://127.0.0.1:{}/'.format(address[1]))
+                for options in [[],['-p','-b','20'],['-s'],['-n','2']]:
+                    # each failed call logs a warning
+                    enriched_tweets = run_enricher(options,config=ASYNC_ENRICHER_CONFIG,env=env,stderr=subprocess.DEVNULL)
+                    self.assertEqual(len(enriched_tweets),len(self.tweets))
+                    self.assertFalse(any('RemoteLengthEnrichment' in tweet.get('enrichments',{}) for tweet in enriched_tweets))
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_stage_plan(self):
+        """ check which enrichments are fused into a stage, and which get their own """
+        class Cheap1(TestEnrichment): pass
+        class Cheap2(TestEnrichment): pass
+        class Cheap3(TestEnrichment): pass
+        class Expensive(TestEnrichment):
+            expensive = True
+        class Async(object):
+            async def enrich(self,tweet):
+                return tweet
+        enrichment_class_list = [(Cheap1,1),(Cheap2,1),(Expensive,1),(Cheap3,1),(Cheap1,3),(Async,1),(Cheap2,1)]
+        self.assertEqual(tweet_enricher.plan_stages(enrichment_class_list),
+                [([Cheap1,Cheap2],1),([Expensive],1),([Cheap3],1),([Cheap1],3),([Async],1),([Cheap2],1)])
+        self.assertEqual(tweet_enricher.plan_stages(enrichment_class_list,fuse=False),
+                [([enrichment_class],n_workers) for enrichment_class,n_workers in enrichment_class_list])
+
+    def test_raw_passthrough_serialization(self):
+        """ check that enrichments spliced into raw lines give valid JSON, whatever the line ending """
+        for line in [b'{"id":"x","body":"a"}\n',b'{"id":"x","body":"a"} \t\r\n',b'{"id":"x","body":"a","enrichments":{"A":1}}\n']:
+            out = tweet_enricher.serialize_raw_record((line,{'B':2}))
+            self.assertTrue(out.endswith(b'}\n'))
+            self.assertEqual(json.loads(out),{'id':'x','body':'a','enrichments':{'B':2}})
+
+    def test_autoscaler_decisions(self):
+        """ check that the autoscaler adds workers to the bottleneck stage, and retires idle ones """
+        worker_counts = [1,2,2]
+        autoscaler = tweet_enricher.WorkerAutoscaler(worker_counts,{0:(1,4),1:(1,4),2:(1,4)},None,None,None,None,1.)
+        # stage 1 is backed up and busy; stage 2 could lose a worker
+        decisions = autoscaler.decide({0:(0.3,0.6),1:(0.9,0.95),2:(0.0,0.1)})
+        self.assertEqual([(stage_idx,change) for stage_idx,change,_ in decisions],[(2,-1),(1,1)])
+        # at the limit on the total workers, one is moved from the least utilized stage that can spare it
+        autoscaler.max_total_workers = 5
+        decisions = autoscaler.decide({0:(0.3,0.1),1:(0.9,0.95),2:(0.3,0.5)})
+        self.assertEqual([(stage_idx,change) for stage_idx,change,_ in decisions],[(2,-1),(1,1)])
+        # the bottleneck is at its upper bound
+        worker_counts[1] = 4
+        self.assertEqual(autoscaler.decide({0:(0.3,0.6),1:(0.9,0.95),2:(0.3,0.5)}),[])
+
+    def test_worker_bounds(self):
+        """ check that autoscaling bounds never start a stage below its configured workers """
+        class Blocking(TestEnrichment): pass
+        class Bounded(TestEnrichment):
+            min_workers = 2
+            max_workers = 3
+        n_cpu = multiprocessing.cpu_count()
+        self.assertEqual(tweet_enricher.get_worker_bounds([Blocking],1,1),(1,n_cpu))
+        self.assertEqual(tweet_enricher.get_worker_bounds([Blocking],n_cpu + 49,1),(1,n_cpu + 49))
+        self.assertEqual(tweet_enricher.get_worker_bounds([Blocking],4,1,2),(1,4))
+        self.assertEqual(tweet_enricher.get_worker_bounds([Blocking],1,1,8),(1,8))
+        self.assertEqual(tweet_enricher.get_worker_bounds([Blocking,Bounded],1,1,8),(2,3))
+
+    def test_async_enrichment(self):
+        """ check the asynchronous enrichment against a local stub model server """
+        server = StubModelServer(('127.0.0.1',0),StubModelHandler)
+        server.n_connections = 0
+        threading.Thread(target=server.serve_forever,daemon=True).start()
+        env = dict(os.environ,MODEL_URL='http://127.0.0.1:{}/'.format(server.server_address[1]))
+        try:
+            for options in [[],['-p','-b','20'],['-s']]:
+                enriched_tweets = run_enricher(options,config=ASYNC_ENRICHER_CONFIG,env=env)
+                self.assertEqual(len(enriched_tweets),len(self.tweets))
+                self.assertTrue(all(tweet['enrichments']['RemoteLengthEnrichment']==len(tweet['body'].encode('utf8')) 
+                    for tweet in enriched_tweets))
+        finally:
+            server.shutdown()
+            server.server_close()
+        # connections are reused, rather than opened for each tweet
+        self.assertLess(server.n_connections,len(self.tweets))
+
     def tearDown(self):
         if not self.line_generator.closed:
             self.line_generator.close()
@@ -0,0 +1,66 @@
+import unittest
+import sys
+import os
+import tempfile
+import subprocess
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import tweet_io
+
+INPUT_FILE_NAME = 'dummy_tweets.json'
+
+class TweetIOTests(unittest.TestCase):
+    """Tests for the shared input and output functions"""
+    def setUp(self):
+        with open(INPUT_FILE_NAME,'rb') as f:
+            self.lines = f.readlines()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.suffixes = ['','.gz','.bz2'] + (['.zst'] if tweet_io.zstandard is not None else [])
+
+    def test_round_trip(self):
+        """ check that lines written in each format are read back, across block boundaries """
+        for suffix in self.suffixes:
+            file_name = os.path.join(self.tmp_dir.name,'tweets.json' + suffix)
+            writer = tweet_io.LineWriter(file_name,block_size=10000)
+            for line in self.lines:
+                writer.write(line)
+            writer.close()
+            self.assertEqual(list(tweet_io.read_lines([file_name],block_size=1000)),self.lines)
+            # a final line without a newline is kept, and files are read in turn
+            with open(os.path.join(self.tmp_dir.name,'tail.json'),'wb') as f:
+                f.write(b'{"id": 1}')
+            self.assertEqual(list(tweet_io.read_lines([file_name,f.name],block_size=1000)),self.lines + [b'{"id": 1}'])
+
+    def test_compressed_pipeline(self):
+        """ check that both scripts read compressed inputs, and that the enricher writes compressed output """
+        input_file = os.path.join(self.tmp_dir.name,'tweets.json.gz')
+        with tweet_io.open_output(input_file) as f:
+            f.write(b''.join(self.lines))
+        output_file = os.path.join(self.tmp_dir.name,'enriched.json.bz2')
+        subprocess.check_call([sys.executable,'tweet_enricher.py','-c','example/my_enrichments.py','-b','20',
+            '-i',input_file,'-o',output_file])
+        enriched_lines = list(tweet_io.read_lines([output_file]))
+        self.assertEqual(len(enriched_lines),len(self.lines))
+        self.assertTrue(all(b'"TestEnrichment": 1' in line for line in enriched_lines))
+        outputs = [subprocess.check_output([sys.executable,'tweet_time_series_builder.py','-c','example/my_measurements.py',
+            '-b','hour','-i',file_name]) for file_name in (INPUT_FILE_NAME,input_file)]
+        self.assertEqual(outputs[0],outputs[1])
+
+    def test_stdin_error_exit(self):
+        """ check that a process exits cleanly on an error while the reader thread waits on a live stdin """
+        process = subprocess.Popen([sys.executable,'-c','import sys, tweet_io; next(tweet_io.read_lines(["-"])); sys.exit(3)'],
+                stdin=subprocess.PIPE,stderr=subprocess.PIPE)
+        process.stdin.write(self.lines[0])
+        process.stdin.flush()
+        # stdin stays open, so the reader thread is still waiting when the process exits
+        returncode = process.wait(timeout=60)
+        stderr = process.stderr.read()
+        process.stdin.close()
+        process.stderr.close()
+        self.assertEqual(returncode,3,stderr)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,15 @@
 import unittest
 import subprocess
 import json
+import sys
+import datetime
+import collections
+import tempfile
+import os
+import pickle
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import tweet_time_series_builder
 
 class TweetCounter(object):
     def __init__(self, **kwargs):
@@ -27,7 +36,53 @@ class ReTweetCounter(object):
     def combine(self,new):
         self.counter += new.counter
 
+class BatchReTweetCounter(ReTweetCounter):
+    fields = ('verb',)
+    def add_batch(self,columns):
+        self.counter += int((columns['verb'] == 'share').sum())
+    def get_name(self):
+        return 'BatchReTweetCounter'
+
+class ItemCounter(object):
+    """ counts the items of a list field, which may be missing """
+    fields = ('items',)
+    def __init__(self, **kwargs):
+        self.counter = 0
+    def add_tweet(self,tweet):
+        self.counter += len(tweet.get('items') or [])
+    def get(self):
+        return [(self.counter,self.get_name())]
+    def get_name(self):
+        return 'ItemCounter'
+    def combine(self,new):
+        self.counter += new.counter
+
+class BatchItemCounter(ItemCounter):
+    def add_batch(self,columns):
+        self.counter += sum(len(items or []) for items in columns['items'])
+    def get_name(self):
+        return 'BatchItemCounter'
+
+class ShareCounter(object):
+    """ a counter measurement, kept in a CounterStore """
+    def __init__(self, **kwargs):
+        pass
+    def count(self,tweet):
+        return tweet['verb'] == 'share'
+    def get_name(self):
+        return 'ShareCounter'
+
 INPUT_FILE_NAME = 'dummy_tweets.json'
+BUILDER_SCRIPT = 'tweet_time_series_builder.py'
+BUILDER_CONFIG = 'example/my_measurements.py'
+TWITTER_DT_FORMAT_STR = "%Y-%m-%dT%H:%M:%S.000Z"
+
+def run_builder(options):
+    """ run the time series builder over the test tweets and return the CSV rows as tuples """
+    with open(INPUT_FILE_NAME) as input_file:
+        out = subprocess.check_output([sys.executable,BUILDER_SCRIPT,'-c',BUILDER_CONFIG] + options,
+                stdin=input_file)
+    return [tuple(line.split(',')) for line in out.decode('utf8').splitlines()]
 
 class AnalysisTests(unittest.TestCase):
     """Tests for the gnip_analysis_pipeline.enrichment package"""
@@ -61,6 +116,189 @@ class AnalysisTests(unittest.TestCase):
         self.assertEqual(tweet_counter.get()[0][0],self.generator_length_truth)  
         self.assertEqual(retweet_counter.get()[0][0],n_retweets)  
 
+    def test_time_buckets(self):
+        """ check the bucketed tweet counts against counts made with datetime """
+        for bucket_size,bucket_size_in_sec in [('second',1),('minute',60),('hour',3600),('day',3600*24),('5minute',300)]:
+            expected_counts = collections.Counter()
+            for tweet in self.tweets:
+                posted_time = datetime.datetime.strptime(tweet['postedTime'],TWITTER_DT_FORMAT_STR)
+                epoch = int((posted_time - datetime.datetime(1970,1,1)).total_seconds())
+                bucket_start = datetime.datetime.utcfromtimestamp(epoch - epoch % bucket_size_in_sec)
+                expected_counts[bucket_start.strftime('%Y%m%d%H%M%S')] += 1
+            counts = {row[0]:int(row[2]) for row in run_builder(['-b',bucket_size]) if row[3] == 'TweetCounter'}
+            self.assertEqual(counts,dict(expected_counts))
+        for bucket_size in ['0minute','0','minutes5','-60']:
+            self.assertRaises(ValueError,tweet_time_series_builder.parse_bucket_size,bucket_size)
+            
+    def test_streaming(self):
+        """ check that streaming mode writes the same rows as a full aggregation of time-ordered tweets """
+        for bucket_size in ['minute','hour']:
+            self.assertEqual(sorted(run_builder(['-b',bucket_size,'-s','-w','0'])),run_builder(['-b',bucket_size]))
+
+    def test_streaming_late_tweets(self):
+        """ check the per-bucket totals and late counts of out-of-order tweets under each late policy """
+        with open(INPUT_FILE_NAME) as input_file:
+            lines = input_file.readlines()
+        # move every 10th tweet 30 tweets later, which makes some of them late
+        for i in range(0,len(lines) - 30,10):
+            lines.insert(i + 30,lines.pop(i))
+        tweets = [json.loads(line) for line in lines]
+        # a tweet is late if the end of its minute bucket isn't after the latest time seen, including its own
+        latest_time, late = '', []
+        for tweet in tweets:
+            latest_time = max(latest_time,tweet['postedTime'])
+            bucket_end = datetime.datetime.strptime(tweet['postedTime'][:16],'%Y-%m-%dT%H:%M') + datetime.timedelta(minutes=1)
+            late.append(bucket_end <= datetime.datetime.strptime(latest_time,TWITTER_DT_FORMAT_STR))
+        self.assertGreater(sum(late),0)
+        get_bucket = lambda tweet: datetime.datetime.strptime(tweet['postedTime'][:16],'%Y-%m-%dT%H:%M').strftime('%Y%m%d%H%M%S')
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            input_file_name = os.path.join(tmp_dir,'shuffled.json')
+            with open(input_file_name,'w') as f:
+                f.writelines(lines)
+            for late_policy in ['drop','update']:
+                with open(input_file_name) as input_file:
+                    process = subprocess.run([sys.executable,BUILDER_SCRIPT,'-c',BUILDER_CONFIG,'-b','minute','-s','-w','0',
+                        '--late-policy',late_policy],stdin=input_file,stdout=subprocess.PIPE,stderr=subprocess.PIPE,check=True)
+                totals = collections.Counter()
+                for row in process.stdout.decode('utf8').splitlines():
+                    row = row.split(',')
+                    if row[3] == 'TweetCounter':
+                        totals[row[0]] += int(row[2])
+                expected_totals = collections.Counter(get_bucket(tweet) for tweet,is_late in zip(tweets,late)
+                        if late_policy == 'update' or not is_late)
+                self.assertEqual(totals,expected_totals)
+                self.assertIn('{} late Tweets were'.format(sum(late)),process.stderr.decode('utf8'))
+
+    def test_file_inputs(self):
+        """ check that aggregating the tweets split over several files gives the same rows as stdin """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with open(INPUT_FILE_NAME) as input_file:
+                lines = input_file.readlines()
+            file_names = []
+            for i in range(0,len(lines),40):
+                file_names.append(os.path.join(tmp_dir,'tweets_{}.json'.format(i)))
+                with open(file_names[-1],'w') as f:
+                    f.writelines(lines[i:i+40])
+            for options in [['-p','2'],['-p','3','-f','4'],['-p','3','-m','7']]:
+                self.assertEqual(run_builder(['-b','minute','-i'] + file_names + options),run_builder(['-b','minute']))
+        # stdin split into chunks of lines
+        self.assertEqual(run_builder(['-b','minute','-p','3','-m','50']),run_builder(['-b','minute']))
+
+    def test_state_file(self):
+        """ check that results stored for unchanged files are combined with those of new and changed files """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with open(INPUT_FILE_NAME) as input_file:
+                lines = input_file.readlines()
+            file_names = [os.path.join(tmp_dir,'tweets_{}.json'.format(i)) for i in range(3)]
+            for file_name,file_lines in zip(file_names,[lines[:100],lines[100:200],lines[200:250]]):
+                with open(file_name,'w') as f:
+                    f.writelines(file_lines)
+            options = ['-b','minute','-p','2','--state-file',os.path.join(tmp_dir,'state.db'),'-i']
+            self.assertEqual(run_builder(options + file_names),run_builder(['-b','minute','-i'] + file_names))
+            # the last file grows, and the others are unchanged
+            with open(file_names[2],'a') as f:
+                f.writelines(lines[250:])
+            for _ in range(2):
+                self.assertEqual(run_builder(options + file_names),run_builder(['-b','minute']))
+
+    def test_partial_files(self):
+        """ check that merging partial results files written for parts of the input gives the same rows """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with open(INPUT_FILE_NAME) as input_file:
+                lines = input_file.readlines()
+            partial_file_names = []
+            for i in range(0,len(lines),100):
+                file_name = os.path.join(tmp_dir,'tweets_{}.json'.format(i))
+                with open(file_name,'w') as f:
+                    f.writelines(lines[i:i+100])
+                partial_file_names.append(file_name + '.partial')
+                run_builder(['-b','minute','-i',file_name,'--write-partial',partial_file_names[-1]])
+            self.assertEqual(run_builder(['--merge-partials'] + partial_file_names),run_builder(['-b','minute']))
+            with open(partial_file_names[0],'rb') as f:
+                self.assertEqual(f.read(8),tweet_time_series_builder.PARTIAL_FILE_MAGIC)
+
+    def test_instrumentation(self):
+        """ check the JSON stats lines written by the main and aggregator processes """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            stats_file = os.path.join(tmp_dir,'stats.jsonl')
+            run_builder(['-b','minute','-p','2','-m','100','--stats-file',stats_file])
+            with open(stats_file) as f:
+                stats_lines = [json.loads(line) for line in f]
+        aggregator_lines = [stats for stats in stats_lines if stats['label'] == 'aggregator']
+        self.assertEqual(len(aggregator_lines),2)
+        for name in ['parse','bucket']:
+            self.assertEqual(sum(stats['histograms'][name]['count'] for stats in aggregator_lines if name in stats['histograms']),
+                    len(self.tweets))
+        self.assertIn('combine',[stats for stats in stats_lines if stats['label'] == 'main'][-1]['histograms'])
+
+    @unittest.skipIf(tweet_time_series_builder.np is None,'NumPy is not installed')
+    def test_ragged_batch_fields(self):
+        """ check 'add_batch' with a field holding lists of differing lengths, or None """
+        tweets = [dict(tweet,items=list(range(i % 3))) if i % 4 else tweet for i,tweet in enumerate(self.tweets)]
+        time_bucketer = tweet_time_series_builder.TimeBucketer(3600)
+        data = tweet_time_series_builder.aggregate([json.dumps(tweet) for tweet in tweets],time_bucketer,{},
+                [ItemCounter,BatchItemCounter],True)
+        self.assertEqual(sum(item_counter.counter for item_counter,_ in data.values()),sum(len(tweet.get('items',[])) for tweet in tweets))
+        for item_counter,batch_item_counter in data.values():
+            self.assertEqual(item_counter.counter,batch_item_counter.counter)
+
+    def test_lazy_decoding(self):
+        """ check counts when 'postedTime' and 'verb' can be extracted without decoding the tweets """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_name = os.path.join(tmp_dir,'tweets.json')
+            with open(file_name,'w') as f:
+                for i,tweet in enumerate(self.tweets):
+                    # Gnip payloads put these fields before any nested object
+                    verb = 'share' if i % 3 == 0 else tweet['verb']
+                    fields = [('postedTime',tweet['postedTime']),('verb',verb)]
+                    fields += [(key,value) for key,value in tweet.items() if key not in ('postedTime','verb')]
+                    f.write('{' + ','.join(json.dumps(key) + ':' + json.dumps(value) for key,value in fields) + '}\n')
+                # a truncated line, whose 'postedTime' and 'verb' can still be extracted, is skipped
+                f.write('{"postedTime":"2016-06-19T00:00:00.000Z","verb":"share","body":"cut of\n')
+            rows = run_builder(['-b','day','-i',file_name])
+        totals = collections.Counter()
+        for row in rows:
+            totals[row[3]] += int(row[2])
+        self.assertEqual(totals['TweetCounter'],len(self.tweets))
+        self.assertEqual(totals['ReTweetCounter'],len(self.tweets[::3]))
+        self.assertNotIn('20160619000000',[row[0] for row in rows])
+        # errors raised by a measurement aren't mistaken for decoding errors
+        class FailingCounter(ReTweetCounter):
+            fields = ('verb',)
+            def add_tweet(self,tweet):
+                raise ValueError('measurement error')
+        with self.assertRaises(ValueError):
+            tweet_time_series_builder.aggregate([json.dumps(self.tweets[0])],tweet_time_series_builder.TimeBucketer(60),
+                    {},[FailingCounter],True)
+
+    @unittest.skipIf(tweet_time_series_builder.np is None,'NumPy is not installed')
+    def test_vectorized_measurements(self):
+        """ check that measurements updated with 'add_batch' agree with 'add_tweet' measurements """
+        lines = [json.dumps(dict(tweet,verb='share' if i % 3 == 0 else tweet['verb'])) for i,tweet in enumerate(self.tweets)]
+        time_bucketer = tweet_time_series_builder.TimeBucketer(60)
+        data = tweet_time_series_builder.aggregate(lines,time_bucketer,{},[ReTweetCounter,BatchReTweetCounter],True)
+        self.assertGreater(len(data),1)
+        for retweet_counter,batch_retweet_counter in data.values():
+            self.assertEqual(retweet_counter.counter,batch_retweet_counter.counter)
+        self.assertEqual(sum(measurements[1].counter for measurements in data.values()),len(self.tweets[::3]))
+
+    def test_counter_store(self):
+        """ check counters kept in a CounterStore against measurement instances, after pickling and combining """
+        lines = [json.dumps(dict(tweet,verb='share' if i % 3 == 0 else tweet['verb'])) for i,tweet in enumerate(self.tweets)]
+        time_bucketer = tweet_time_series_builder.TimeBucketer(1)
+        measurement_class_list = [ReTweetCounter,ShareCounter]
+        combiner = tweet_time_series_builder.Combiner()
+        for chunk in [lines[:len(lines)//2],lines[len(lines)//2:]]:
+            chunk_data = tweet_time_series_builder.aggregate(chunk,time_bucketer,{},measurement_class_list,True)
+            combiner.add( pickle.loads(pickle.dumps(chunk_data)) )
+        data = combiner.get_data()
+        # more buckets than the initial size of the store
+        self.assertGreater(len(data),tweet_time_series_builder.CounterStore.INITIAL_ROWS)
+        for measurements in data.values():
+            counts = dict((name,count) for measurement in measurements for count,name in measurement.get())
+            self.assertEqual(counts['ShareCounter'],counts['ReTweetCounter'])
+        self.assertEqual(sum(measurements[0].counter for measurements in data.values()),len(self.tweets[::3]))
+
     def tearDown(self):
         if not self.line_generator.closed:
             self.line_generator.close()
@@ -7,8 +7,17 @@ import sys
 import threading
 import queue
 import time
+import asyncio
+import collections
+import hashlib
+import sqlite3
 import logging
 import multiprocessing as mp
+from multiprocessing import shared_memory
+import pickle
+import struct
+from pipeline_stats import Stats, start_instrumentation, profile_target
+from tweet_io import read_lines, chunk_lines, LineWriter
 try:
     import ujson as json
 except ImportError:
@@ -18,104 +27,1117 @@ logging.basicConfig(level=logging.WARN,
         format='%(asctime)s %(module)s:%(lineno)s - %(levelname)s - %(message)s'
         )
 
-def worker_func(enrichment_class,enrichment_idx,worker_idx):
+# set to a 'Stats' object with '--stats-file'
+stats = None
+# with autoscaling, the busy time of the workers of each stage
+busy_seconds = None
+# with '--preserve-order' and the 'block' policy, the slots of the reorder window
+window_slots = None
+
+class TweetBatcher(object):
+    """
+    Accumulates tweets into lists and puts each list on a queue once it
+    reaches 'batch_size' tweets or has been waiting for 'timeout' seconds;
+    a background thread handles the timeout for slow input streams.
+
+    Batches are put on the queue as (sequence number, batch) tuples. If a 
+    'slots' semaphore is given, one slot is acquired for each batch, which 
+    bounds the number of batches in flight.
+    """
+    def __init__(self,output_q,batch_size,timeout,slots=None):
+        self.output_q = output_q
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.slots = slots
+        self.seq = 0
+        self.batch = []
+        self.batch_start = None
+        self.lock = threading.Lock()
+        self.closed = threading.Event()
+        self.flush_thread = threading.Thread(target=self._flush_on_timeout,daemon=True)
+        self.flush_thread.start()
+
+    def add(self,tweet):
+        with self.lock:
+            if not self.batch:
+                self.batch_start = time.time()
+            self.batch.append(tweet)
+            if len(self.batch) >= self.batch_size:
+                self._flush()
+
+    def _flush(self):
+        if self.batch:
+            if self.slots is not None:
+                self.slots.acquire()
+            self.output_q.put((self.seq,self.batch))
+            self.seq += 1
+            self.batch = []
+
+    def _flush_on_timeout(self):
+        while not self.closed.wait(self.timeout):
+            with self.lock:
+                if self.batch and time.time() - self.batch_start >= self.timeout:
+                    self._flush()
+
+    def close(self):
+        """ stop the timeout thread and put any partial batch on the queue """
+        self.closed.set()
+        self.flush_thread.join()
+        with self.lock:
+            self._flush()
+
+class ReorderBuffer(object):
+    """
+    Restores the input order of sequence-numbered batches that arrive out of
+    order from stages with several workers.
+
+    At most 'window' batches are held. When the window is full, the 'block'
+    policy relies on the main loop waiting for a free slot (see 'TweetBatcher'),
+    so the window can't overflow; the 'flush' policy gives up on the missing 
+    batches and emits the buffered ones, and missing batches are then written 
+    as soon as they arrive.
+    """
+    def __init__(self,window,policy):
+        self.window = window
+        self.policy = policy
+        self.pending = {}
+        self.next_seq = 0
+        self.n_buffered = 0
+        self.n_out_of_order = 0
+        self.total_wait = 0.
+        self.max_wait = 0.
+
+    def add(self,seq,batch):
+        """ add a batch, and return the list of batches that are now ready to be written """
+        now = time.time()
+        if seq < self.next_seq:
+            # this batch was skipped when the window overflowed
+            self.n_out_of_order += 1
+            return [batch]
+        self.pending[seq] = (batch,now)
+        ready = self._pop_ready(now)
+        if self.policy == 'flush' and len(self.pending) > self.window:
+            self.next_seq = min(self.pending)
+            ready += self._pop_ready(now)
+        return ready
+
+    def _pop_ready(self,now):
+        ready = []
+        while self.next_seq in self.pending:
+            batch, arrival_time = self.pending.pop(self.next_seq)
+            if now > arrival_time:
+                self.n_buffered += 1
+                self.total_wait += now - arrival_time
+                self.max_wait = max(self.max_wait,now - arrival_time)
+            ready.append(batch)
+            self.next_seq += 1
+        return ready
+
+    def drain(self):
+        """ return all buffered batches, in order """
+        ready = [self.pending[seq][0] for seq in sorted(self.pending)]
+        self.pending = {}
+        return ready
+
+    def get_stats(self):
+        mean_wait = self.total_wait/self.n_buffered if self.n_buffered else 0.
+        return (f"reorder buffer held {self.n_buffered} batches for a mean of {mean_wait:.4f} s "
+                f"(max {self.max_wait:.4f} s); {self.n_out_of_order} batches written out of order")
+
+class SharedMemoryQueue(object):
+    """
+    A multi-producer, multi-consumer queue that passes pickled objects 
+    through a ring buffer in shared memory, with the interface of 
+    'multiprocessing.JoinableQueue' used by the concurrent architecture.
+
+    Each record in the ring is a 4-byte length prefix followed by the pickled
+    object. Producers block while the ring is too full for a new record, and
+    consumers block while it is empty. 'None' is passed like any other object,
+    so it remains the end-of-stream signal.
+
+    An object too large for the ring is passed through an ordinary 
+    'multiprocessing.Queue' instead, with a marker record in the ring in its
+    place; the consumer that takes a marker takes the next object from that
+    queue. A warning is logged the first time this happens in each process.
+
+    Parameters
+    ----------
+    size : int
+        Capacity of the ring buffer in bytes
+    """
+    HEADER = struct.Struct('<I')
+    # the length prefix of a marker record, for an object in the overflow queue
+    SPILLED = 2**32 - 1
+    # indices into the shared state array
+    HEAD, TAIL, N_RECORDS, UNFINISHED = range(4)
+
+    def __init__(self,size):
+        self.size = size
+        self.shm = shared_memory.SharedMemory(create=True,size=size)
+        self.state = mp.RawArray('q',4)
+        self.lock = mp.Lock()
+        self.not_empty = mp.Condition(self.lock)
+        self.not_full = mp.Condition(self.lock)
+        self.all_tasks_done = mp.Condition(self.lock)
+        self.overflow = mp.Queue()
+        self.warned = False
+
+    def _write(self,position,data):
+        offset = position % self.size
+        n_first = min(len(data),self.size - offset)
+        self.shm.buf[offset:offset + n_first] = data[:n_first]
+        if n_first < len(data):
+            self.shm.buf[:len(data) - n_first] = data[n_first:]
+
+    def _read(self,position,length):
+        offset = position % self.size
+        n_first = min(length,self.size - offset)
+        data = bytes(self.shm.buf[offset:offset + n_first])
+        if n_first < length:
+            data += bytes(self.shm.buf[:length - n_first])
+        return data
+
+    def put(self,obj):
+        data = pickle.dumps(obj,protocol=pickle.HIGHEST_PROTOCOL)
+        if self.HEADER.size + len(data) > self.size:
+            if not self.warned:
+                logging.warning(f"a record of {len(data)} bytes doesn't fit in a ring buffer of {self.size} bytes, "
+                        "so it's passed through an ordinary queue; raise --ring-buffer-size or lower -b")
+                self.warned = True
+            # the object is on its way before its marker can be taken
+            self.overflow.put(data)
+            record = self.HEADER.pack(self.SPILLED)
+        else:
+            record = self.HEADER.pack(len(data)) + data
+        state = self.state
+        with self.not_full:
+            while self.size - (state[self.TAIL] - state[self.HEAD]) < len(record):
+                self.not_full.wait()
+            self._write(state[self.TAIL],record)
+            state[self.TAIL] += len(record)
+            state[self.N_RECORDS] += 1
+            state[self.UNFINISHED] += 1
+            self.not_empty.notify()
+
+    def get(self):
+        state = self.state
+        with self.not_empty:
+            while state[self.N_RECORDS] == 0:
+                self.not_empty.wait()
+            length, = self.HEADER.unpack(self._read(state[self.HEAD],self.HEADER.size))
+            if length == self.SPILLED:
+                data = None
+                state[self.HEAD] += self.HEADER.size
+            else:
+                data = self._read(state[self.HEAD] + self.HEADER.size,length)
+                state[self.HEAD] += self.HEADER.size + length
+            state[self.N_RECORDS] -= 1
+            self.not_full.notify_all()
+        if data is None:
+            data = self.overflow.get()
+        return pickle.loads(data)
+
+    def task_done(self):
+        with self.lock:
+            self.state[self.UNFINISHED] -= 1
+            if self.state[self.UNFINISHED] == 0:
+                self.all_tasks_done.notify_all()
+
+    def join(self):
+        with self.all_tasks_done:
+            while self.state[self.UNFINISHED] > 0:
+                self.all_tasks_done.wait()
+
+    def qsize(self):
+        return self.state[self.N_RECORDS]
+
+    def close(self):
+        """ release the shared memory; call once, from the creating process """
+        self.shm.close()
+        self.shm.unlink()
+        self.overflow.close()
+
+def tweet_from_record(record):
+    """
+    Get a Tweet dict from a queue record, or None if the record isn't a Tweet.
+
+    With raw passthrough, a record is a tuple of the original input line
+    bytes and the Tweet's current 'enrichments' dict (None before the first
+    enrichment), and the line is parsed again in each stage. Otherwise, a 
+    record is the Tweet dict itself.
+    """
+    if not args.raw_passthrough:
+        return record
+    line, enrichments = record
+    try:
+        tweet = json.loads(line)
+    except ValueError:
+        return None
+    if 'body' not in tweet:
+        return None
+    if enrichments is not None:
+        tweet['enrichments'] = enrichments
+    return tweet
+
+def record_from_tweet(tweet,record):
+    """
+    Make the queue record for an enriched Tweet; with raw passthrough, the 
+    'enrichments' dict is kept alongside the original line bytes, and the
+    rest of the parsed Tweet is dropped
+    """
+    if not args.raw_passthrough:
+        return tweet
+    return (record[0],tweet.get('enrichments'))
+
+def serialize_raw_record(record):
+    """
+    Produce the output bytes for a raw passthrough record by splicing the
+    enrichments into the original line, re-serializing the whole Tweet only 
+    when the input line already contained enrichments or doesn't end with
+    the closing brace of the object
+    """
+    line, enrichments = record
+    line = line.rstrip()
+    if enrichments is None:
+        return line + b'\n'
+    if b'"enrichments"' not in line and line.endswith(b'}'):
+        return line[:-1] + b',"enrichments":' + json.dumps(enrichments).encode('utf8') + b'}\n'
+    tweet = json.loads(line)
+    tweet['enrichments'] = enrichments
+    return json.dumps(tweet).encode('utf8') + b'\n'
+
+def is_async_enrichment(enrichment_class):
+    """ check for an enrichment that implements 'enrich' or 'enrich_batch' as a coroutine """
+    return (asyncio.iscoroutinefunction(getattr(enrichment_class,'enrich',None)) 
+            or asyncio.iscoroutinefunction(getattr(enrichment_class,'enrich_batch',None)))
+
+def is_parallel_enrichment(enrichment_class,n_workers):
+    """ 
+    an enrichment gets its own stage if it's marked expensive, has several workers,
+    or is asynchronous
+    """
+    return (n_workers > 1 or getattr(enrichment_class,'expensive',False) 
+            or is_async_enrichment(enrichment_class))
+
+def plan_stages(enrichment_class_list,fuse=True):
+    """
+    Group the configured enrichments into the stages of the concurrent architecture
+
+    Consecutive cheap enrichments are fused into one single-worker stage that
+    runs them back-to-back on each tweet, which saves a queue hop per enrichment.
+    An enrichment class is marked as expensive with a class attribute 
+    'expensive = True'.
+
+    Returns
+    -------
+    list of (list of enrichment classes, number of workers) tuples
+    """
+    stage_list = []
+    for enrichment_class,n_workers in enrichment_class_list:
+        parallel = is_parallel_enrichment(enrichment_class,n_workers)
+        if (fuse and not parallel and stage_list
+                and not is_parallel_enrichment(stage_list[-1][0][-1],stage_list[-1][1])):
+            stage_list[-1][0].append(enrichment_class)
+        else:
+            stage_list.append(([enrichment_class],n_workers))
+    return stage_list
+
+def get_worker_bounds(stage_classes,n_workers,min_workers,max_workers=None):
+    """
+    The autoscaling bounds on the number of workers of a stage configured with
+    'n_workers'; the class attributes 'min_workers' and 'max_workers' override
+    the command-line values, and the narrowest bounds of the stage's 
+    enrichments apply. The default 'max_workers' is the larger of 'n_workers'
+    and the number of cores, and the upper bound is never below 'n_workers', 
+    so a stage never starts with fewer workers than configured.
+    """
+    if max_workers is None:
+        max_workers = max(n_workers,mp.cpu_count())
+    lower = max(getattr(enrichment_class,'min_workers',min_workers) for enrichment_class in stage_classes)
+    upper = min(getattr(enrichment_class,'max_workers',max_workers) for enrichment_class in stage_classes)
+    return lower, max(lower,upper,n_workers)
+
+class WorkerAutoscaler(object):
+    """
+    Adjusts the number of workers of stages of the concurrent architecture
+    while it runs, within each stage's (min, max) bounds.
+
+    A thread samples how full each stage's input queue is several times per
+    'interval' seconds. At the end of each interval it also measures the
+    utilization of the stage's workers, i.e. the fraction of the interval they
+    spent enriching. Time spent waiting on queues doesn't count, so a stage
+    held up by a slower stage downstream looks idle.
+
+    The stage whose input queue backs up while its workers are busy is the
+    bottleneck, and gets one more worker per interval. A stage whose queue is
+    nearly empty, and whose remaining workers would not be busy without one of
+    them, retires a worker. If the total number of workers is at
+    'max_total_workers', a worker is moved to the bottleneck from the least
+    utilized stage that can spare one.
+
+    Parameters
+    ----------
+    worker_counts : list of int
+        Number of workers of each stage, which is updated in place
+    bounds : dict
+        (min, max) number of workers for each stage index to be scaled
+    get_fullness : function
+        Takes a stage index and returns the fill fraction of its input queue
+    get_busy_seconds : function
+        Takes a stage index and returns the total time its workers have spent enriching
+    add_worker, retire_worker : function
+        Take a stage index and start, or signal the exit of, one worker of the stage
+    """
+    N_SAMPLES = 5
+    HIGH_FULLNESS = 0.5
+    LOW_FULLNESS = 0.1
+    HIGH_UTILIZATION = 0.8
+    LOW_UTILIZATION = 0.5
+
+    def __init__(self,worker_counts,bounds,get_fullness,get_busy_seconds,add_worker,retire_worker,
+            interval,max_total_workers=None,stage_names=None,log=logging.info):
+        self.worker_counts = worker_counts
+        self.bounds = bounds
+        self.get_fullness = get_fullness
+        self.get_busy_seconds = get_busy_seconds
+        self.add_worker = add_worker
+        self.retire_worker = retire_worker
+        self.interval = interval
+        self.max_total_workers = max_total_workers
+        self.stage_names = stage_names or {}
+        self.log = log
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run,daemon=True)
+
+    def can_retire(self,stage_idx,fullness,utilization):
+        """ whether a stage can lose a worker without becoming busy """
+        n_workers = self.worker_counts[stage_idx]
+        return (n_workers > self.bounds[stage_idx][0] and fullness <= self.LOW_FULLNESS
+                and utilization*n_workers/(n_workers - 1) < self.LOW_UTILIZATION)
+
+    def decide(self,loads):
+        """
+        Choose changes to the worker counts, from the (input queue fullness, worker
+        utilization) of each scaled stage over the last interval
+
+        Returns
+        -------
+        list of (stage index, +1 or -1, reason) tuples
+        """
+        describe = lambda stage_idx: "input queue {:.0%} full, workers {:.0%} busy".format(*loads[stage_idx])
+        decisions = []
+        idle = [stage_idx for stage_idx,(fullness,utilization) in loads.items()
+                if self.can_retire(stage_idx,fullness,utilization)]
+        bottlenecks = [stage_idx for stage_idx,(fullness,utilization) in loads.items()
+                if fullness >= self.HIGH_FULLNESS and utilization >= self.HIGH_UTILIZATION
+                and self.worker_counts[stage_idx] < self.bounds[stage_idx][1]]
+        if bottlenecks:
+            bottleneck = max(bottlenecks,key=lambda stage_idx: loads[stage_idx][0]*loads[stage_idx][1])
+            n_total = sum(self.worker_counts) - len(idle)
+            if self.max_total_workers is None or n_total < self.max_total_workers:
+                decisions.append((bottleneck,1,"bottleneck: " + describe(bottleneck)))
+            else:
+                donors = [stage_idx for stage_idx,(fullness,utilization) in loads.items()
+                        if stage_idx != bottleneck and stage_idx not in idle
+                        and self.worker_counts[stage_idx] > self.bounds[stage_idx][0]
+                        and utilization < self.HIGH_UTILIZATION]
+                if donors:
+                    donor = min(donors,key=lambda stage_idx: loads[stage_idx][1])
+                    decisions.append((donor,-1,f"moving a worker to stage {bottleneck}: " + describe(donor)))
+                    decisions.append((bottleneck,1,"bottleneck: " + describe(bottleneck)))
+        return [(stage_idx,-1,"idle: " + describe(stage_idx)) for stage_idx in idle] + decisions
+
+    def apply(self,stage_idx,change,reason):
+        n_workers = self.worker_counts[stage_idx]
+        if change > 0:
+            self.add_worker(stage_idx)
+        else:
+            self.retire_worker(stage_idx)
+        self.worker_counts[stage_idx] += change
+        self.log(f"Autoscaler: stage {stage_idx} ({self.stage_names.get(stage_idx,'')}) "
+                f"{n_workers} -> {self.worker_counts[stage_idx]} workers; {reason}")
+
+    def _run(self):
+        fullness_sums = dict.fromkeys(self.bounds,0.)
+        n_samples = 0
+        last_time = time.perf_counter()
+        last_busy_seconds = {stage_idx:self.get_busy_seconds(stage_idx) for stage_idx in self.bounds}
+        while not self.stopped.wait(self.interval/self.N_SAMPLES):
+            for stage_idx in self.bounds:
+                fullness_sums[stage_idx] += self.get_fullness(stage_idx)
+            n_samples += 1
+            if n_samples < self.N_SAMPLES:
+                continue
+            now = time.perf_counter()
+            loads = {}
+            for stage_idx in self.bounds:
+                busy_seconds = self.get_busy_seconds(stage_idx)
+                utilization = (busy_seconds - last_busy_seconds[stage_idx])/((now - last_time)*self.worker_counts[stage_idx])
+                loads[stage_idx] = (fullness_sums[stage_idx]/n_samples,utilization)
+                last_busy_seconds[stage_idx] = busy_seconds
+            for stage_idx,change,reason in self.decide(loads):
+                self.apply(stage_idx,change,reason)
+            fullness_sums = dict.fromkeys(self.bounds,0.)
+            n_samples = 0
+            last_time = now
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+class AsyncEnrichmentCaller(object):
+    """
+    Calls an asynchronous enrichment with up to 'max_in_flight' calls to 'enrich'
+    (or 'enrich_batch') in flight. Each call is limited to 'request_timeout' 
+    seconds, and tweets whose call times out or raises an error are logged 
+    and passed on without this enrichment. The class attributes 'max_in_flight'
+    and 'request_timeout' override the command-line values.
+
+    With a 'latency_name', the time of each call is recorded with '--stats-file'.
+    A caller must only be used on one event loop.
+    """
+    def __init__(self,enrichment_class_instance,latency_name=None):
+        self.instance = enrichment_class_instance
+        enrichment_class = type(enrichment_class_instance)
+        self.name = enrichment_class.__name__
+        self.max_in_flight = getattr(enrichment_class,'max_in_flight',args.max_in_flight)
+        self.timeout = getattr(enrichment_class,'request_timeout',args.request_timeout)
+        self.use_batch = asyncio.iscoroutinefunction(getattr(enrichment_class_instance,'enrich_batch',None))
+        self.latency_name = latency_name
+        self.in_flight = None
+
+    def _record_latency(self,start_time):
+        if stats is not None and self.latency_name is not None:
+            stats.add_time(self.latency_name,time.perf_counter() - start_time)
+
+    async def enrich_one(self,tweet):
+        async with self.in_flight:
+            start_time = time.perf_counter()
+            try:
+                enriched_tweet = await asyncio.wait_for(self.instance.enrich(tweet),self.timeout)
+            except asyncio.TimeoutError:
+                logging.warning(f"{self.name} timed out on tweet {tweet.get('id')}")
+                return tweet
+            except Exception as e:
+                logging.warning(f"{self.name} failed on tweet {tweet.get('id')}: {e!r}")
+                return tweet
+            finally:
+                self._record_latency(start_time)
+        return enriched_tweet if enriched_tweet is not None else tweet
+
+    async def enrich_many(self,tweets):
+        async with self.in_flight:
+            start_time = time.perf_counter()
+            try:
+                enriched_tweets = await asyncio.wait_for(self.instance.enrich_batch(tweets),self.timeout)
+            except asyncio.TimeoutError:
+                logging.warning(f"{self.name} timed out on a batch of {len(tweets)} tweets")
+                return tweets
+            except Exception as e:
+                logging.warning(f"{self.name} failed on a batch of {len(tweets)} tweets: {e!r}")
+                return tweets
+            finally:
+                self._record_latency(start_time)
+        return enriched_tweets if enriched_tweets is not None else tweets
+
+    async def enrich_all(self,tweets):
+        """ enrich a list of tweets, and return the list of enriched tweets """
+        if self.in_flight is None:
+            # the semaphore belongs to the loop that runs the calls
+            self.in_flight = asyncio.Semaphore(self.max_in_flight)
+        if not tweets:
+            return tweets
+        if self.use_batch:
+            return await self.enrich_many(tweets)
+        return list(await asyncio.gather(*[self.enrich_one(tweet) for tweet in tweets]))
+
+class SyncEnrichmentAdapter(object):
+    """
+    Runs an asynchronous enrichment one micro-batch at a time on a private event
+    loop, for the architectures that call enrichments directly (-s and -n), 
+    with the limits and error handling of 'AsyncEnrichmentCaller'
+    """
+    def __init__(self,enrichment_class_instance):
+        self.instance = enrichment_class_instance
+        self.caller = AsyncEnrichmentCaller(enrichment_class_instance)
+        self.loop = asyncio.new_event_loop()
+        if hasattr(self.instance,'open'):
+            self.loop.run_until_complete(self.instance.open())
+
+    def enrich(self,tweet):
+        return self.enrich_batch([tweet])[0]
+
+    def enrich_batch(self,tweets):
+        return self.loop.run_until_complete(self.caller.enrich_all(tweets))
+
+class CachedEnrichment(object):
+    """
+    Caches the results of an enrichment, as the items that it adds to the 
+    'enrichments' dict of each tweet, in an in-memory LRU and optionally 
+    in a SQLite file that persists across runs.
+
+    The cache key is the enrichment class name, the class's 'version' 
+    attribute, and either the tweet 'id' or, if the class sets 
+    'cache_key = "body"', a hash of the tweet body; the latter lets retweets 
+    share results. A class opts out of caching with 'cacheable = False'.
+
+    Hit and miss counts are logged when the worker exits.
     """
-    This function runs on a new worker, gets from an input queue,
-    enriches tweets with one enrichment, and puts to an output queue. 
+    def __init__(self,enrichment_class_instance,enrichment_class,cache_size,cache_file=None):
+        self.instance = enrichment_class_instance
+        self.name = enrichment_class.__name__
+        self.key_prefix = '{}:{}:'.format(self.name,getattr(enrichment_class,'version',''))
+        self.key_by_body = getattr(enrichment_class,'cache_key','id') == 'body'
+        self.cache_size = cache_size
+        self.lru = collections.OrderedDict()
+        self.db = None
+        if cache_file is not None:
+            self.db = sqlite3.connect(cache_file,timeout=60,check_same_thread=False)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS enrichment_cache (key TEXT PRIMARY KEY, value TEXT)')
+            self.db.commit()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        mp.util.Finalize(self,self.report,exitpriority=10)
+
+    def get_key(self,tweet):
+        if self.key_by_body:
+            return self.key_prefix + hashlib.sha1(tweet['body'].encode('utf8')).hexdigest()
+        return self.key_prefix + str(tweet['id'])
+
+    def _remember(self,key,value):
+        self.lru[key] = value
+        self.lru.move_to_end(key)
+        if len(self.lru) > self.cache_size:
+            self.lru.popitem(last=False)
+
+    def lookup(self,tweets):
+        """
+        Apply cached results to 'tweets', and return the list of tweets that 
+        missed the cache, with their keys and a copy of their 'enrichments' 
+        """
+        misses = []
+        disk_keys = []
+        for tweet in tweets:
+            key = self.get_key(tweet)
+            value = self.lru.get(key)
+            if value is not None:
+                self.lru.move_to_end(key)
+                self.memory_hits += 1
+                tweet.setdefault('enrichments',{}).update(json.loads(value))
+            else:
+                disk_keys.append((tweet,key))
+        if disk_keys and self.db is not None:
+            found = dict(self.db.execute('SELECT key, value FROM enrichment_cache WHERE key IN ({})'.format(
+                ','.join('?'*len(disk_keys))),[key for _,key in disk_keys]).fetchall())
+        else:
+            found = {}
+        for tweet,key in disk_keys:
+            if key in found:
+                self.disk_hits += 1
+                self._remember(key,found[key])
+                tweet.setdefault('enrichments',{}).update(json.loads(found[key]))
+            else:
+                self.misses += 1
+                misses.append((tweet,key,dict(tweet.get('enrichments') or {})))
+        return misses
+
+    def store(self,misses,enriched_tweets):
+        """ cache the enrichment items added to each tweet that missed the cache """
+        rows = []
+        for (_,key,previous_enrichments),tweet in zip(misses,enriched_tweets):
+            delta = {name:value for name,value in (tweet.get('enrichments') or {}).items() 
+                    if previous_enrichments.get(name,self) is not value}
+            try:
+                value = json.dumps(delta)
+            except TypeError:
+                continue
+            self._remember(key,value)
+            rows.append((key,value))
+        if rows and self.db is not None:
+            self.db.executemany('INSERT OR REPLACE INTO enrichment_cache (key, value) VALUES (?,?)',rows)
+            self.db.commit()
+
+    def enrich_batch(self,tweets):
+        misses = self.lookup(tweets)
+        if misses:
+            enriched_tweets = enrich_tweets([self.instance],[tweet for tweet,_,_ in misses])
+            self.store(misses,enriched_tweets)
+            # an enrichment may return new tweet objects
+            enriched_tweets = iter(enriched_tweets)
+            missed_ids = set(id(tweet) for tweet,_,_ in misses)
+            tweets = [next(enriched_tweets) if id(tweet) in missed_ids else tweet for tweet in tweets]
+        return tweets
+
+    def report(self):
+        logging.warning(f"{self.name} cache: {self.memory_hits} memory hits, {self.disk_hits} disk hits, "
+                f"{self.misses} misses")
+        if self.db is not None:
+            self.db.close()
+
+def make_cache(enrichment_class_instance,enrichment_class):
+    """ wrap an enrichment in a cache, if caching is enabled for it """
+    if args.cache and getattr(enrichment_class,'cacheable',True):
+        return CachedEnrichment(enrichment_class_instance,enrichment_class,args.cache_size,args.cache_file)
+    return None
+
+def make_enrichment_instance(enrichment_class):
+    """ instantiate an enrichment class for synchronous use """
+    if is_async_enrichment(enrichment_class):
+        instance = SyncEnrichmentAdapter(enrichment_class())
+    else:
+        instance = enrichment_class()
+    return make_cache(instance,enrichment_class) or instance
+
+def get_enrichment_name(enrichment_class_instance):
+    """ the name under which an enrichment's latency is reported """
+    if isinstance(enrichment_class_instance,CachedEnrichment):
+        # the wrapped enrichment's own calls are reported under its class name
+        return enrichment_class_instance.name + ' (cached)'
+    if isinstance(enrichment_class_instance,SyncEnrichmentAdapter):
+        return type(enrichment_class_instance.instance).__name__
+    return type(enrichment_class_instance).__name__
+
+def enrich_tweets(enrichment_class_instances,tweets):
+    """ 
+    Run a chain of enrichments on a list of tweets
+
+    An enrichment with an 'enrich_batch' method gets the whole list, while
+    'enrich' is called for each tweet. Either may modify the tweets in place
+    or return new ones. With '--stats-file', the time each enrichment takes
+    for the list is recorded.
+    """
+    for enrichment_class_instance in enrichment_class_instances:
+        if stats is not None:
+            start_time = time.perf_counter()
+        if hasattr(enrichment_class_instance,'enrich_batch'):
+            enriched_tweets = enrichment_class_instance.enrich_batch(tweets)
+            if enriched_tweets is not None:
+                tweets = enriched_tweets
+        else:
+            for i,tweet in enumerate(tweets):
+                enriched_tweet = enrichment_class_instance.enrich(tweet)
+                if enriched_tweet is not None:
+                    tweets[i] = enriched_tweet
+        if stats is not None:
+            stats.add_time('enrichment.' + get_enrichment_name(enrichment_class_instance),time.perf_counter() - start_time)
+    return tweets
+
+def worker_func(stage_classes,stage_idx,worker_idx):
+    """
+    This function runs on a new worker, gets batches of tweets from an input queue,
+    enriches the batch with the enrichments of one stage, and puts the batch to 
+    an output queue. 
 
     Parameters
     ----------
-    enrichment_class : class definition object
-    enrichment_idx : int 
-        Index of enrichment in enrichment list
+    stage_classes : list of class definition objects
+        Enrichment classes run, in order, on each tweet
+    stage_idx : int 
+        Index of stage in stage list
     worker_idx : int
-        Index of worker for this enrichment
+        Index of worker for this stage
     """
 
-    enrichment_class_instance = enrichment_class()
-    input_q = queue_pool[enrichment_idx]
-    output_q = queue_pool[enrichment_idx+1]
+    if stats is not None:
+        stats.start(f"stage{stage_idx}-worker{worker_idx}")
+    enrichment_class_instances = [make_enrichment_instance(enrichment_class) for enrichment_class in stage_classes]
+    input_q = queue_pool[stage_idx]
+    output_q = queue_pool[stage_idx+1]
 
     logging.info(f"Entered worker {worker_idx}") 
     while True:
         try:
-            tweet = input_q.get() 
+            batch = input_q.get() 
         except TypeError:
             input_q.task_done()
             continue
+        if stats is not None or busy_seconds is not None:
+            start_time = time.perf_counter()
 
-        if tweet is None: # this is the signal to exit
+        if batch is None: # this is the signal to exit
             logging.info(f"Worker {worker_idx} got None") 
             input_q.task_done()
             break
-        logging.debug(f"Worker {worker_idx} got tweet {tweet['id']}")
+        seq, batch = batch
+        logging.debug(f"Worker {worker_idx} got batch {seq} of {len(batch)} tweets")
         
-        enriched_tweet = enrichment_class_instance.enrich(tweet)
-        if enriched_tweet is not None:
-            tweet = enriched_tweet
+        pairs = [(record,tweet_from_record(record)) for record in batch]
+        pairs = [(record,tweet) for record,tweet in pairs if tweet is not None]
+        tweets = enrich_tweets(enrichment_class_instances,[tweet for _,tweet in pairs])
+        enriched_batch = [record_from_tweet(tweet,record) for (record,_),tweet in zip(pairs,tweets)]
+        if stats is not None or busy_seconds is not None:
+            busy_time = time.perf_counter() - start_time
+            if stats is not None:
+                # the busy fraction of this histogram is the worker's utilization
+                stats.add_time(f"stage{stage_idx}.worker{worker_idx}.busy",busy_time)
+            if busy_seconds is not None:
+                # the autoscaler's measure of the stage's utilization
+                with busy_seconds[stage_idx].get_lock():
+                    busy_seconds[stage_idx].value += busy_time
         
-        output_q.put(tweet)
+        output_q.put((seq,enriched_batch))
         input_q.task_done()
     logging.info(f"Exiting worker {worker_idx}")
     
+def async_worker_func(stage_classes,stage_idx,worker_idx):
+    """
+    This function runs on a new worker for a stage holding one asynchronous 
+    enrichment, and runs the stage on an asyncio event loop
+    """
+    asyncio.run(run_async_stage(stage_classes[0],stage_idx,worker_idx))
+
+async def run_async_stage(enrichment_class,stage_idx,worker_idx):
+    """
+    Gets batches of tweets from an input queue, and enriches them with an 
+    asynchronous enrichment through an 'AsyncEnrichmentCaller', with up to 
+    'max_in_flight' batches in progress.
+    
+    If the enrichment defines 'open' and 'close' coroutines, they are awaited
+    once per worker, so that the enrichment can set up and reuse connections
+    to an external model.
+    """
+    if stats is not None:
+        stats.start(f"stage{stage_idx}-worker{worker_idx}")
+    enrichment_class_instance = enrichment_class()
+    cache = make_cache(enrichment_class_instance,enrichment_class)
+    caller = AsyncEnrichmentCaller(enrichment_class_instance,latency_name='enrichment.' + enrichment_class.__name__)
+    input_q = queue_pool[stage_idx]
+    output_q = queue_pool[stage_idx+1]
+    loop = asyncio.get_running_loop()
+    batch_slots = asyncio.Semaphore(caller.max_in_flight)
+    batch_tasks = set()
+
+    async def process_batch(seq,batch):
+        try:
+            pairs = [(record,tweet_from_record(record)) for record in batch]
+            pairs = [(record,tweet) for record,tweet in pairs if tweet is not None]
+            tweets = [tweet for _,tweet in pairs]
+            if cache is not None:
+                misses = cache.lookup(tweets)
+                to_enrich = [tweet for tweet,_,_ in misses]
+            else:
+                to_enrich = tweets
+            enriched_tweets = await caller.enrich_all(to_enrich)
+            if cache is not None:
+                cache.store(misses,enriched_tweets)
+                enriched_tweets = iter(enriched_tweets)
+                missed_ids = set(id(tweet) for tweet in to_enrich)
+                tweets = [next(enriched_tweets) if id(tweet) in missed_ids else tweet for tweet in tweets]
+            else:
+                tweets = enriched_tweets
+            enriched_batch = [record_from_tweet(tweet,record) for (record,_),tweet in zip(pairs,tweets)]
+            await loop.run_in_executor(None,output_q.put,(seq,enriched_batch))
+        except Exception:
+            logging.exception(f"{enrichment_class.__name__} worker {worker_idx} dropped batch {seq}")
+        finally:
+            # the stage's input queue can only be joined once every batch is marked done
+            input_q.task_done()
+            batch_slots.release()
+
+    if hasattr(enrichment_class_instance,'open'):
+        await enrichment_class_instance.open()
+    if stats is not None:
+        stats.add_gauge(f"stage{stage_idx}.worker{worker_idx}.in_flight_batches",lambda: len(batch_tasks))
+    logging.info(f"Entered async worker {worker_idx}") 
+    while True:
+        await batch_slots.acquire()
+        item = await loop.run_in_executor(None,input_q.get)
+        if item is None: # this is the signal to exit
+            logging.info(f"Async worker {worker_idx} got None") 
+            break
+        task = asyncio.ensure_future(process_batch(*item))
+        batch_tasks.add(task)
+        task.add_done_callback(batch_tasks.discard)
+        if stats is not None:
+            stats.count(f"stage{stage_idx}.worker{worker_idx}.batches")
+
+    if batch_tasks:
+        await asyncio.wait(batch_tasks)
+    if hasattr(enrichment_class_instance,'close'):
+        await enrichment_class_instance.close()
+    input_q.task_done()
+    logging.info(f"Exiting async worker {worker_idx}")
+
+def serialize_batch(batch):
+    """ serialize a batch of records as the output bytes """
+    if args.raw_passthrough:
+        return b''.join([serialize_raw_record(record) for record in batch])
+    return ''.join([json.dumps(tweet) + '\n' for tweet in batch]).encode('utf8')
+
 def output_func():
     """
-    Serializes enriched Tweet objects; runs on a dedicated worker
+    Serializes batches of enriched Tweet objects; runs on a dedicated worker
     """
 
+    if stats is not None:
+        stats.start("output")
     input_q = queue_pool[-1]
     logging.info("entered output worker") 
+    # the writer's thread belongs to this worker, so it's created here
+    output_writer = LineWriter(args.output_file)
     counter = 0
+    reorder_buffer = ReorderBuffer(args.reorder_window,args.reorder_policy) if args.preserve_order else None
 
     while True:
 
-        tweet = input_q.get()
-        if tweet is None: # this is the signal to exit
+        item = input_q.get()
+        if item is None: # this is the signal to exit
             logging.info(f"Output worker got None") 
             input_q.task_done()
-            break
+            ready = reorder_buffer.drain() if reorder_buffer is not None else []
+        else:
+            seq, batch = item
+            ready = reorder_buffer.add(seq,batch) if reorder_buffer is not None else [batch]
 
-        counter += 1
-        if args.verbose and counter%1000==0:
-            logging.warn(f"{counter} tweets enriched\n")
-        
-        out_str = json.dumps(tweet) + '\n' 
         try:
-            sys.stdout.write(out_str) 
+            for batch in ready:
+                if stats is not None:
+                    start_time = time.perf_counter()
+                output_writer.write(serialize_batch(batch))
+                if stats is not None:
+                    stats.add_time("output.write",time.perf_counter() - start_time)
+                    stats.count("output.tweets",len(batch))
+                if window_slots is not None:
+                    window_slots.release()
+                previous_counter = counter
+                counter += len(batch)
+                if args.verbose and counter//1000 > previous_counter//1000:
+                    logging.warning(f"{counter} tweets enriched\n")
         except BrokenPipeError: # check for closed output pipe
             break
+        if item is None:
+            break
+    try:
+        output_writer.close()
+    except BrokenPipeError:
+        pass
+
+    if reorder_buffer is not None:
+        log_stats = logging.warning if args.verbose else logging.info
+        log_stats(reorder_buffer.get_stats())
     logging.info(f"Exiting output worker")
 
+def init_shard_worker(enrichment_class_list):
+    """ create the enrichment class instances on each process of the sharded architecture """
+    global class_instance_list
+    start_instrumentation(stats,args.profile_dir,"shard")
+    class_instance_list = [make_enrichment_instance(class_definition) for class_definition,_ in enrichment_class_list]
+
+def shard_func(lines):
+    """
+    Decodes, enriches and encodes a chunk of input lines in a process of the 
+    sharded architecture, and returns the output bytes for the chunk
+    """
+    pairs = []
+    for line in lines:
+        try:
+            tweet = json.loads(line)
+        except ValueError:
+            continue
+        if 'body' in tweet:
+            pairs.append((line,tweet))
+    tweets = enrich_tweets(class_instance_list,[tweet for _,tweet in pairs])
+    if args.raw_passthrough:
+        out = [serialize_raw_record((line,tweet.get('enrichments'))) for (line,_),tweet in zip(pairs,tweets)]
+    else:
+        out = [json.dumps(tweet).encode('utf8') + b'\n' for tweet in tweets]
+    return b''.join(out)
+
+def run_sharded_operation(n_shards):
+    """
+    Split the input lines into chunks and run the full enrichment chain on each 
+    chunk in one of 'n_shards' identical processes; output is written in 
+    chunks, in input order unless '--unordered' is specified
+    """
+    slots = threading.Semaphore(n_shards*4)
+    pool = mp.Pool(processes=n_shards,initializer=init_shard_worker,initargs=(enrichment_class_list,))
+    chunks = chunk_lines(read_lines(args.input_files),args.shard_chunk_size,slots)
+    map_func = pool.imap_unordered if args.unordered else pool.imap
+    output_writer = LineWriter(args.output_file)
+    counter = 0
+    try:
+        for out_bytes in map_func(shard_func,chunks):
+            slots.release()
+            output_writer.write(out_bytes)
+            if stats is not None:
+                stats.count("output.tweets",out_bytes.count(b'\n'))
+            previous_counter = counter
+            counter += out_bytes.count(b'\n')
+            if args.verbose and counter//1000 > previous_counter//1000:
+                logging.warning(f"{counter} tweets enriched\n")
+        output_writer.close()
+    except BrokenPipeError: # check for closed output pipe
+        pool.terminate()
+    else:
+        pool.close()
+    pool.join()
+
+class SimpleOutput(object):
+    """
+    Enriches and writes batches of tweets in the simple architecture; 
+    the 'put' method lets a 'TweetBatcher' feed micro-batches to it
+    """
+    def __init__(self,enrichment_class_instances,output_writer):
+        self.enrichment_class_instances = enrichment_class_instances
+        self.output_writer = output_writer
+        self.closed = False
+
+    def put(self,item):
+        seq, batch = item
+        if self.closed:
+            return
+        tweets = enrich_tweets(self.enrichment_class_instances,batch)
+        try:
+            self.output_writer.write(''.join([json.dumps(tweet) + '\n' for tweet in tweets]).encode('utf8'))
+        except IOError:
+            # account for closed output pipe
+            self.closed = True
+
+    def close(self):
+        try:
+            self.output_writer.close()
+        except IOError:
+            pass
+
+def start_stage_worker(stage_idx):
+    """ start one more worker for a stage of the concurrent architecture """
+    stage_classes = stage_list[stage_idx][0]
+    worker_idx = len(worker_pool_list[stage_idx])
+    stage_func = async_worker_func if is_async_enrichment(stage_classes[0]) else worker_func
+    worker = worker_type(target=stage_func if args.profile_dir is None else 
+            profile_target(args.profile_dir,f"stage{stage_idx}-worker{worker_idx}",stage_func),
+        args=(stage_classes,stage_idx,worker_idx))
+    worker.start()
+    worker_pool_list[stage_idx].append(worker)
+
+def retire_stage_worker(stage_idx):
+    """ signal one worker of a stage to exit, once the batches queued ahead of the signal are taken """
+    queue_pool[stage_idx].put(None)
+
+def get_queue_fullness(queue_idx):
+    """ the fraction of a queue's capacity in use, or 0 where the size of a queue is unavailable """
+    q = queue_pool[queue_idx]
+    if isinstance(q,SharedMemoryQueue):
+        return (q.state[q.TAIL] - q.state[q.HEAD])/float(q.size)
+    try:
+        return q.qsize()/float(queue_maxsizes[queue_idx])
+    except NotImplementedError:
+        return 0.
+
 def cleanup_concurrent_operation():
     """
     Flush the queues and join the queues and workers  
     The "all done" signal is None
     """
     
-    for enrichment_idx,(enrichment_class,n_workers) in enumerate(enrichment_class_list):
-        # cause the worker functions on each worker to exit
+    # put any partially-filled batch on the input queue
+    batcher.close()
+    if autoscaler is not None:
+        autoscaler.stop()
+
+    for stage_idx,n_workers in enumerate(stage_worker_counts):
+        # cause the worker functions on each worker to exit; 
+        # workers retired by the autoscaler already have their signal
         for i in range(n_workers):
-            queue_pool[enrichment_idx].put(None)
-        # join this enrichment's input queue
-        queue_pool[enrichment_idx].join()
-        # join this enrichment's workers
-        [worker.join() for worker in worker_pool_list[enrichment_idx]]
+            queue_pool[stage_idx].put(None)
+        # join this stage's input queue
+        queue_pool[stage_idx].join()
+        # join this stage's workers
+        [worker.join() for worker in worker_pool_list[stage_idx]]
     
     queue_pool[-1].put(None)
     output_worker.join()
 
+    if args.shared_memory:
+        [q.close() for q in queue_pool]
+
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser()
     parser.add_argument('-c','--configuration-file',dest='config_file',default=None,
             help='python file defining "enrichment_class_list"') 
+    parser.add_argument('-i','--input-files',dest='input_files',nargs='+',default=['-'],
+            help='input files, decompressed if they end in .gz, .bz2 or .zst; default is stdin') 
+    parser.add_argument('-o','--output-file',dest='output_file',default='-',
+            help='output file, compressed if it ends in .gz, .bz2 or .zst; default is stdout') 
     parser.add_argument('-s','--simple-version',dest='do_simple_architecture',action='store_true',default=False,
             help='use simple, non-concurrent architecture') 
     parser.add_argument('-p','--use-processes',dest='use_processes',action='store_true',default=False,
             help='use processes instread of threads') 
     parser.add_argument('-v','--display-counter',dest='verbose',action='store_true',default=False,
             help='display counter of enriched tweets') 
+    parser.add_argument('-b','--batch-size',dest='batch_size',type=int,default=1,
+            help='number of tweets passed between workers, and to "enrich_batch", at a time; default is %(default)s') 
+    parser.add_argument('-t','--batch-timeout',dest='batch_timeout',type=float,default=0.1,
+            help='max seconds a partial batch waits before being passed on; default is %(default)s') 
+    parser.add_argument('-r','--raw-passthrough',dest='raw_passthrough',action='store_true',default=False,
+            help='pass input line bytes, with their enrichments, between workers that parse them in each stage; useful with -p') 
+    parser.add_argument('-m','--shared-memory',dest='shared_memory',action='store_true',default=False,
+            help='pass tweets between processes through shared memory ring buffers; requires -p') 
+    parser.add_argument('--ring-buffer-size',dest='ring_buffer_size',type=float,default=8,
+            help='size in MB of each shared memory ring buffer; larger batches go through an ordinary queue; default is %(default)s') 
+    parser.add_argument('--no-fusion',dest='no_fusion',action='store_true',default=False,
+            help='run each enrichment in its own stage, rather than fusing consecutive cheap enrichments') 
+    parser.add_argument('-n','--shards',dest='n_shards',type=int,default=None,
+            help='run the full enrichment chain in this many identical processes, each on chunks of the input') 
+    parser.add_argument('--shard-chunk-size',dest='shard_chunk_size',type=int,default=1000,
+            help='number of input lines per chunk in sharded mode; default is %(default)s') 
+    parser.add_argument('-u','--unordered',dest='unordered',action='store_true',default=False,
+            help='in sharded mode, write chunks in order of completion rather than input order') 
+    parser.add_argument('--preserve-order',dest='preserve_order',action='store_true',default=False,
+            help='write tweets in input order, even when stages have several workers') 
+    parser.add_argument('--reorder-window',dest='reorder_window',type=int,default=100,
+            help='max number of batches held to restore input order; default is %(default)s') 
+    parser.add_argument('--reorder-policy',dest='reorder_policy',choices=['block','flush'],default='block',
+            help='when the reorder window is full, block the input or write out of order; default is %(default)s') 
+    parser.add_argument('--max-in-flight',dest='max_in_flight',type=int,default=100,
+            help='max concurrent calls per worker of an asynchronous enrichment; default is %(default)s') 
+    parser.add_argument('--request-timeout',dest='request_timeout',type=float,default=10.,
+            help='max seconds for each call of an asynchronous enrichment; default is %(default)s') 
+    parser.add_argument('--cache',dest='cache',action='store_true',default=False,
+            help='cache enrichment results, keyed by tweet id or body hash') 
+    parser.add_argument('--cache-file',dest='cache_file',default=None,
+            help='SQLite file in which enrichment results are cached across runs; implies --cache') 
+    parser.add_argument('--cache-size',dest='cache_size',type=int,default=100000,
+            help='number of results held in memory for each cached enrichment; default is %(default)s') 
+    parser.add_argument('-a','--autoscale',dest='autoscale',action='store_true',default=False,
+            help='add and retire workers of each stage during the run, from its queue back-pressure and worker utilization') 
+    parser.add_argument('--min-workers',dest='min_workers',type=int,default=1,
+            help='fewest workers of an autoscaled stage; default is %(default)s') 
+    parser.add_argument('--max-workers',dest='max_workers',type=int,default=None,
+            help='most workers of an autoscaled stage, which keeps at least its configured number; default is the larger of that number and the number of cores') 
+    parser.add_argument('--max-total-workers',dest='max_total_workers',type=int,default=None,
+            help='most workers of all stages; beyond this, the autoscaler moves workers to the bottleneck stage') 
+    parser.add_argument('--autoscale-interval',dest='autoscale_interval',type=float,default=5.,
+            help='seconds between autoscaling decisions; default is %(default)s') 
+    parser.add_argument('--stats-file',dest='stats_file',default=None,
+            help='append JSON lines of latency histograms, queue depths and worker utilization for each process to this file, or "-" for stderr') 
+    parser.add_argument('--stats-interval',dest='stats_interval',type=float,default=10.,
+            help='seconds between JSON stats lines; default is %(default)s') 
+    parser.add_argument('--profile-dir',dest='profile_dir',default=None,
+            help='write a cProfile file for the main process and each worker to this directory') 
     args = parser.parse_args()
+    if args.cache_file is not None:
+        args.cache = True
+
+    stats = Stats(args.stats_file,args.stats_interval) if args.stats_file is not None else None
+    start_instrumentation(stats,args.profile_dir,"main")
+
+    if args.n_shards is not None and args.do_simple_architecture:
+        parser.error('sharded mode (-n) and the simple architecture (-s) are exclusive')
+    if args.raw_passthrough and args.do_simple_architecture:
+        parser.error('raw passthrough (-r) requires the concurrent architecture')
+    if args.shared_memory and (args.do_simple_architecture or not args.use_processes):
+        parser.error('shared memory transport (-m) requires processes (-p)')
+    if args.autoscale and (args.do_simple_architecture or args.n_shards is not None):
+        parser.error('autoscaling requires the concurrent architecture, without -s or -n')
+    if args.min_workers < 1 or (args.max_workers is not None and args.max_workers < args.min_workers):
+        parser.error('worker bounds must satisfy 1 <= --min-workers <= --max-workers')
 
     if args.config_file is None:
         sys.stderr.write('No configuration file specified; no enrichments will be run.\n') 
@@ -136,11 +1158,24 @@ if __name__ == '__main__':
         else:
             sys.stderr.write(args.config_file + ' does not define "enrichment_class_list"; no enrichments will be run.\n')
    
+    if args.n_shards is not None:
+        run_sharded_operation(args.n_shards)
+        if stats is not None:
+            stats.stop()
+        sys.exit(0)
+
     if args.do_simple_architecture: 
         # create instances of all configured classes
-        class_instance_list = [class_definition() for class_definition,_ in enrichment_class_list]
+        class_instance_list = [make_enrichment_instance(class_definition) for class_definition,_ in enrichment_class_list]
+        # tweets are enriched in micro-batches, for enrichments that implement 'enrich_batch'
+        simple_output = SimpleOutput(class_instance_list,LineWriter(args.output_file))
+        batcher = TweetBatcher(simple_output,args.batch_size,args.batch_timeout)
     else: # use concurrent architecture
-        if args.use_processes:
+        if args.shared_memory:
+            # ring buffers are bounded by their size in bytes, not by a number of items
+            queue_type = lambda maxsize: SharedMemoryQueue(int(args.ring_buffer_size*2**20))
+            worker_type = mp.Process
+        elif args.use_processes:
             queue_type = mp.JoinableQueue
             worker_type = mp.Process
         else:
@@ -150,42 +1185,93 @@ if __name__ == '__main__':
         # set up workers and queues
         input_q = queue_type(10)
         queue_pool = [input_q] # input queue is the first element of queue_pool
+        queue_maxsizes = [10]
         worker_pool_list = []
 
+        stage_list = plan_stages(enrichment_class_list,fuse=not args.no_fusion)
+        stage_names = {stage_idx:"+".join(enrichment_class.__name__ for enrichment_class in stage_classes)
+                for stage_idx,(stage_classes,_) in enumerate(stage_list)}
+
+        # asynchronous stages scale through their requests in flight, rather than their workers
+        if args.autoscale:
+            worker_bounds = {stage_idx:get_worker_bounds(stage_classes,n_workers,args.min_workers,args.max_workers)
+                    for stage_idx,(stage_classes,n_workers) in enumerate(stage_list) 
+                    if not is_async_enrichment(stage_classes[0])}
+            busy_seconds = [mp.Value('d',0.) for _ in stage_list]
+        else:
+            worker_bounds = {}
+            busy_seconds = None
+        stage_worker_counts = [min(max(n_workers,worker_bounds[stage_idx][0]),worker_bounds[stage_idx][1]) 
+                if stage_idx in worker_bounds else n_workers for stage_idx,(_,n_workers) in enumerate(stage_list)]
+        log_plan = logging.warning if args.verbose else logging.info
+        log_plan("Enrichment stage plan: " + " | ".join("{} x{}".format(stage_names[stage_idx],n_workers)
+            for stage_idx,n_workers in enumerate(stage_worker_counts)))
+
         # create and start all enrichment workers
-        for enrichment_idx,(enrichment_class,n_workers) in enumerate(enrichment_class_list):
-            logging.info("Starting {} workers for enrichment {}".format(n_workers,enrichment_class.__name__))
-            queue_pool.append(queue_type(n_workers*2 + 1))
-            worker_pool = [worker_type(target=worker_func,
-                args=(enrichment_class,enrichment_idx,worker_idx)) 
-                for worker_idx in range(n_workers)] 
-            [worker.start() for worker in worker_pool]
-            worker_pool_list.append(worker_pool)
+        for stage_idx,n_workers in enumerate(stage_worker_counts):
+            logging.info("Starting {} workers for stage {}".format(n_workers,stage_idx))
+            # an autoscaled stage's output queue is sized for its most workers
+            maxsize = max(n_workers,worker_bounds.get(stage_idx,(0,0))[1])*2 + 1
+            queue_pool.append(queue_type(maxsize))
+            queue_maxsizes.append(maxsize)
+            worker_pool_list.append([])
+            for worker_idx in range(n_workers):
+                start_stage_worker(stage_idx)
+
+        # bound the number of batches in flight, so that the reorder buffer can't overflow
+        if args.preserve_order and args.reorder_policy == 'block':
+            window_slots = mp.Semaphore(args.reorder_window) if args.use_processes else threading.Semaphore(args.reorder_window)
+        else:
+            window_slots = None
 
         # create and start output worker
-        output_worker = worker_type(target=output_func)
+        output_worker = worker_type(target=output_func if args.profile_dir is None else 
+                profile_target(args.profile_dir,"output",output_func))
         output_worker.start()
 
-    ## main loop over tweets
-    for line in sys.stdin: 
-        try:
-            tweet = json.loads(line)
-        except ValueError:
-            continue
-        if 'body' not in tweet:
-            continue
+        if stats is not None:
+            # sample the depth of every queue
+            for queue_idx,q in enumerate(queue_pool):
+                stats.add_gauge(f"queue{queue_idx}.depth",q.qsize)
+            for stage_idx in worker_bounds:
+                stats.add_gauge(f"stage{stage_idx}.workers",lambda stage_idx=stage_idx: stage_worker_counts[stage_idx])
+
+        if worker_bounds:
+            autoscaler = WorkerAutoscaler(stage_worker_counts,worker_bounds,get_queue_fullness,
+                    lambda stage_idx: busy_seconds[stage_idx].value,start_stage_worker,retire_stage_worker,
+                    args.autoscale_interval,args.max_total_workers,stage_names,log=log_plan)
+            autoscaler.start()
+        else:
+            autoscaler = None
+
+        # tweets are put on the input queue in batches
+        batcher = TweetBatcher(input_q,args.batch_size,args.batch_timeout,slots=window_slots)
 
-        if args.do_simple_architecture:
-            for cls_instance in class_instance_list:
-                tweet = cls_instance.enrich(tweet)
+    ## main loop over tweets
+    if args.raw_passthrough:
+        # lines are parsed by the workers of the first enrichment
+        for line in read_lines(args.input_files):
+            if b'"body"' in line:
+                batcher.add((line,None))
+    else:
+        for line in read_lines(args.input_files): 
             try:
-                sys.stdout.write(json.dumps(tweet) + '\n') 
-            except IOError:
-                # account for closed output pipe
+                tweet = json.loads(line)
+            except ValueError:
+                continue
+            if 'body' not in tweet:
+                continue
+
+            batcher.add(tweet) 
+            if args.do_simple_architecture and simple_output.closed:
                 break
-        else:
-            input_q.put(tweet) 
 
-    if not args.do_simple_architecture:
+    if args.do_simple_architecture:
+        batcher.close()
+        simple_output.close()
+    else:
         cleanup_concurrent_operation()
+
+    if stats is not None:
+        stats.stop()
    
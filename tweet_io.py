@@ -0,0 +1,221 @@
+"""
+Line-oriented input and output shared by the Tweet enricher and the time
+series builder, for plain files, stdin/stdout ("-"), and gzip, bz2 and
+(with the 'zstandard' package) zstd files, as chosen by the file name suffix.
+
+Input is read and decompressed in large blocks on a background thread,
+which hands lists of lines to the consumer. Output is collected into large
+blocks that a background thread compresses and writes. zlib, bz2 and zstd
+release the GIL while they work, so decompression, compression and the
+read and write system calls overlap with parsing and enrichment.
+"""
+import io
+import os
+import sys
+import itertools
+import gzip
+import bz2
+import queue
+import functools
+import threading
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+DEFAULT_BLOCK_SIZE = 2**20
+COMPRESSION_SUFFIXES = {'.gz':'gzip','.bz2':'bz2','.zst':'zstd'}
+COMPRESSION_LEVELS = {'gzip':6,'bz2':9,'zstd':3}
+
+def get_compression(file_name):
+    """ the compression format of a file, from its suffix, or None """
+    for suffix,compression in COMPRESSION_SUFFIXES.items():
+        if file_name.endswith(suffix):
+            return compression
+    return None
+
+def _check_zstd(file_name):
+    if zstandard is None:
+        raise ValueError(f"{file_name}: zstd files require the 'zstandard' package")
+
+def open_input(file_name,block_size=DEFAULT_BLOCK_SIZE):
+    """ open a file, or stdin for '-', for reading decompressed bytes """
+    if file_name == '-':
+        return sys.stdin.buffer
+    compression = get_compression(file_name)
+    # files are opened by name, or with closefd, so that closing the reader closes the file
+    if compression == 'gzip':
+        return gzip.open(file_name,'rb')
+    if compression == 'bz2':
+        return bz2.open(file_name,'rb')
+    if compression == 'zstd':
+        _check_zstd(file_name)
+        return zstandard.ZstdDecompressor().stream_reader(open(file_name,'rb',buffering=block_size),
+                read_size=block_size,read_across_frames=True,closefd=True)
+    return open(file_name,'rb',buffering=block_size)
+
+def open_output(file_name):
+    """ open a file, or stdout for '-', for writing bytes, which are compressed as the suffix says """
+    if file_name == '-':
+        return sys.stdout.buffer
+    compression = get_compression(file_name)
+    if compression == 'gzip':
+        return gzip.open(file_name,'wb',compresslevel=COMPRESSION_LEVELS['gzip'])
+    if compression == 'bz2':
+        return bz2.open(file_name,'wb',compresslevel=COMPRESSION_LEVELS['bz2'])
+    if compression == 'zstd':
+        _check_zstd(file_name)
+        compressor = zstandard.ZstdCompressor(level=COMPRESSION_LEVELS['zstd'],threads=-1)
+        return compressor.stream_writer(open(file_name,'wb'))
+    return open(file_name,'wb')
+
+def _read_blocks(file_names,block_size,blocks,stopped):
+    """ put lists of the lines of 'file_names' on the 'blocks' queue, then None """
+    def put(item):
+        while not stopped.is_set():
+            try:
+                blocks.put(item,timeout=0.1)
+                return
+            except queue.Full:
+                continue
+    try:
+        for file_name in file_names:
+            if file_name == '-':
+                # stdin may be a live stream, so take whatever is available rather than waiting for 
+                # a full block; os.read doesn't hold the lock of sys.stdin.buffer, which would make
+                # the interpreter abort at exit while this thread waits
+                f = None
+                read = functools.partial(os.read,sys.stdin.fileno())
+            else:
+                f = open_input(file_name,block_size)
+                read = f.read
+            remainder = b''
+            try:
+                while not stopped.is_set():
+                    block = read(block_size)
+                    if not block:
+                        break
+                    if remainder:
+                        block = remainder + block
+                    end = block.rfind(b'\n') + 1
+                    remainder = block[end:]
+                    if end > 0:
+                        put(io.BytesIO(block[:end]).readlines())
+                if remainder:
+                    put([remainder])
+            finally:
+                if f is not None:
+                    f.close()
+        put(None)
+    except Exception as e:
+        put(e)
+
+def read_blocks(file_names,block_size=DEFAULT_BLOCK_SIZE,prefetch=4):
+    """
+    Generate lists of lines (as bytes, with line endings) of each file in turn,
+    read and decompressed on a background thread that stays at most 'prefetch'
+    blocks of about 'block_size' bytes ahead. Errors in reading are raised here.
+    """
+    blocks = queue.Queue(prefetch)
+    stopped = threading.Event()
+    thread = threading.Thread(target=_read_blocks,args=(file_names,block_size,blocks,stopped),daemon=True)
+    thread.start()
+    try:
+        while True:
+            block = blocks.get()
+            if block is None:
+                break
+            if isinstance(block,Exception):
+                raise block
+            yield block
+    finally:
+        # the thread may be waiting on a live stream, so it's left to exit on its own
+        stopped.set()
+
+def read_lines(file_names,block_size=DEFAULT_BLOCK_SIZE,prefetch=4):
+    """ generate the lines (as bytes) of each file in turn; see 'read_blocks' """
+    for block in read_blocks(file_names,block_size,prefetch):
+        yield from block
+
+def chunk_lines(line_iterator,chunk_size,slots):
+    """
+    Yield lists of 'chunk_size' lines, acquiring one of the 'slots' semaphore
+    for each, which bounds the number of chunks in flight
+    """
+    while True:
+        chunk = list(itertools.islice(line_iterator,chunk_size))
+        if not chunk:
+            break
+        slots.acquire()
+        yield chunk
+
+class LineWriter(object):
+    """
+    Collects output bytes into blocks of 'block_size' bytes, which a background
+    thread compresses (according to the file name) and writes. The caller
+    waits only when 'max_pending' blocks are waiting to be written. Output
+    that has waited 'flush_interval' seconds without filling a block is
+    written and flushed, so that a slow stream of input isn't held back.
+
+    An error in writing, such as a BrokenPipeError, is raised by the next
+    call to 'write' or 'close'.
+    """
+    def __init__(self,file_name,block_size=DEFAULT_BLOCK_SIZE,max_pending=4,flush_interval=1.):
+        self.file_name = file_name
+        self.file = open_output(file_name)
+        self.block_size = block_size
+        self.max_pending = max_pending
+        self.flush_interval = flush_interval
+        self.parts = []
+        self.size = 0
+        self.closed = False
+        self.error = None
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._write_blocks,daemon=True)
+        self.thread.start()
+
+    def write(self,data):
+        with self.condition:
+            while self.error is None and self.size >= self.block_size*self.max_pending:
+                self.condition.wait()
+            if self.error is not None:
+                raise self.error
+            self.parts.append(data)
+            self.size += len(data)
+            if self.size >= self.block_size:
+                self.condition.notify_all()
+
+    def _write_blocks(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.size >= self.block_size or self.closed,self.flush_interval)
+                timed_out = self.size < self.block_size
+                parts, self.parts, self.size = self.parts, [], 0
+                closed = self.closed
+                self.condition.notify_all()
+            try:
+                if parts:
+                    self.file.write(b''.join(parts))
+                    if timed_out and not closed:
+                        self.file.flush()
+                if closed:
+                    if self.file_name == '-':
+                        self.file.flush()
+                    else:
+                        self.file.close()
+                    return
+            except Exception as e:
+                with self.condition:
+                    self.error = e
+                    self.condition.notify_all()
+                return
+
+    def close(self):
+        """ write any remaining output and close the file (stdout is only flushed) """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
@@ -9,13 +9,34 @@ import multiprocessing
 import itertools
 import time
 import logging
-import fileinput
+import calendar
+import re
+import functools
+import threading
+import mmap
+import collections
+import array
+import operator
+import sqlite3
+import pickle
+import hashlib
+import struct
+import zlib
+import heapq
 
 try:
     import ujson as json 
 except ImportError:
     import json
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from pipeline_stats import Stats, start_instrumentation
+from tweet_io import read_lines, chunk_lines, get_compression
+
 TWITTER_DT_FORMAT_STR = "%Y-%m-%dT%H:%M:%S.000Z"
 
 """
@@ -29,64 +50,636 @@ handler.setLevel(logging.INFO)
 logger.addHandler( handler )
 logger.setLevel(logging.INFO)
 
+# set to a 'Stats' object with '--stats-file'
+stats = None
+
+class TimeBucketer(object):
+    """
+    Maps 'postedTime' strings to time bucket keys.
+
+    'postedTime' has a fixed layout (see TWITTER_DT_FORMAT_STR), so the keys for
+    buckets of a second, minute, hour or day are made by slicing the string, 
+    rather than by parsing and formatting a datetime. Other bucket sizes are 
+    computed from integer epoch seconds, with buckets aligned to the epoch.
+    Recent keys are memoized by the 'postedTime' prefix that determines them.
+
+    Parameters
+    ----------
+    bucket_size_in_sec : int
+        Size of the time buckets
+    """
+    KEY_FORMATS = {1:"%Y%m%d%H%M%S", 60:"%Y%m%d%H%M", 3600:"%Y%m%d%H", 3600*24:"%Y%m%d"}
+    # length of the 'postedTime' prefix that determines the key of each standard bucket size
+    PREFIX_LENGTHS = {1:19, 60:16, 3600:13, 3600*24:10}
+    KEY_LENGTHS = {1:14, 60:12, 3600:10, 3600*24:8}
+    MEMO_SIZE = 4096
+
+    def __init__(self,bucket_size_in_sec):
+        self.bucket_size_in_sec = bucket_size_in_sec
+        # format of the bucket keys, which must be parsable by datetime.strptime
+        self.key_format = self.KEY_FORMATS.get(bucket_size_in_sec,"%Y%m%d%H%M%S")
+        self.prefix_length = self.PREFIX_LENGTHS.get(bucket_size_in_sec,19)
+        self.memo = {}
+
+    def get_key(self,posted_time):
+        prefix = posted_time[:self.prefix_length]
+        key = self.memo.get(prefix)
+        if key is None:
+            key = self._make_key(posted_time)
+            if len(self.memo) >= self.MEMO_SIZE:
+                self.memo.clear()
+            self.memo[prefix] = key
+        return key
+
+    def _make_key(self,posted_time):
+        p = posted_time
+        if len(p) < 19 or p[4] != '-' or p[7] != '-' or p[10] != 'T' or p[13] != ':' or p[16] != ':':
+            # not the expected layout; parse it the slow way
+            p = datetime.datetime.strptime(posted_time,TWITTER_DT_FORMAT_STR).strftime("%Y-%m-%dT%H:%M:%S")
+        if self.bucket_size_in_sec in self.KEY_FORMATS:
+            return (p[0:4] + p[5:7] + p[8:10] + p[11:13] + p[14:16] + p[17:19])[:self.KEY_LENGTHS[self.bucket_size_in_sec]]
+        epoch = self.get_epoch(p)
+        epoch -= epoch % self.bucket_size_in_sec
+        return time.strftime(self.key_format,time.gmtime(epoch))
+
+    def get_start(self,time_bucket_key):
+        """ get the start of a time bucket in epoch seconds """
+        return calendar.timegm(time.strptime(time_bucket_key,self.key_format))
+
+    def get_epoch(self,posted_time):
+        """ get a 'postedTime' in epoch seconds """
+        p = posted_time
+        return calendar.timegm((int(p[0:4]),int(p[5:7]),int(p[8:10]),int(p[11:13]),int(p[14:16]),int(p[17:19])))
+
+def parse_bucket_size(bucket_size):
+    """ 
+    Get the size in seconds of a bucket specified as a unit (second,minute,hour,day),
+    a multiple of a unit (e.g. '5minute' or '15minutes'), or a number of seconds
+    """
+    unit_seconds = {'second':1,'minute':60,'hour':3600,'day':3600*24}
+    match = re.match(r'^(\d*)\s*(second|minute|hour|day)s?$',bucket_size)
+    if match is not None and int(match.group(1) or 1) > 0:
+        return int(match.group(1) or 1) * unit_seconds[match.group(2)]
+    if bucket_size.isdigit() and int(bucket_size) > 0:
+        return int(bucket_size)
+    raise ValueError("Time bucket size '{}' is not implemented".format(bucket_size)) 
+
 def aggregate_file(file_name,
-        TWITTER_DT_FORMAT_STR,
-        dt_bucket_format,
+        time_bucketer,
         config_kwargs,
         measurement_class_list,
         keep_empty_entries):
     """
     Aggregator acting on a file name
-    File is decompressed and an iterator is passed to 'aggregate'
+    File is decompressed on a background thread and its lines are passed to 'aggregate'
     """
-    decompressed_file_object = fileinput.input(files=file_name,openhook=fileinput.hook_compressed)
-    return aggregate(decompressed_file_object,
-            TWITTER_DT_FORMAT_STR,
-            dt_bucket_format,
+    return aggregate(read_lines([file_name]),
+            time_bucketer,
             config_kwargs,
             measurement_class_list,
             keep_empty_entries) 
 
+def is_compressed(file_name):
+    """ check for a file that 'tweet_io.read_lines' will decompress """
+    return get_compression(file_name) is not None
+
+def read_file_range(file_name,start,end):
+    """ 
+    Generate the lines of a file that start in the byte range [start,end);
+    ranges that split a file at arbitrary offsets each get whole lines.
+    The file is memory-mapped, and lines are found without buffered reads.
+    """
+    with open(file_name,'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ) as mm:
+            position = start
+            if start > 0:
+                # skip the rest of a line that starts in the previous range
+                newline = mm.find(b'\n',start - 1)
+                position = newline + 1 if newline != -1 else end
+            while position < end:
+                newline = mm.find(b'\n',position)
+                if newline == -1:
+                    yield mm[position:]
+                    break
+                yield mm[position:newline + 1]
+                position = newline + 1
+
+# default numbers of Tweets in a chunk; stdin chunks are held in memory, up to 2 per process
+DEFAULT_FILE_CHUNK_TWEETS = 1000000
+DEFAULT_STDIN_CHUNK_TWEETS = 10000
+# a lower bound on the size of a serialized Tweet, in bytes
+MIN_LINE_SIZE = 100
+
+def estimate_line_size(file_name,sample_size=2**16):
+    """ estimate the mean line length of a file, in bytes, from its start """
+    with open(file_name,'rb') as f:
+        sample = f.read(sample_size)
+    return len(sample)/max(sample.count(b'\n'),1)
+
+def make_chunks(file_names,max_tweets):
+    """
+    Split input files into chunks of about 'max_tweets' lines, as 
+    (file name, start byte, end byte, size in bytes) tuples. Compressed files
+    can't be split at arbitrary offsets, so each one is a single chunk,
+    with None for the start and end.
+    """
+    chunks = []
+    for file_name in file_names:
+        file_size = os.path.getsize(file_name)
+        if is_compressed(file_name):
+            chunks.append((file_name,None,None,file_size))
+            continue
+        if file_size <= max_tweets*MIN_LINE_SIZE:
+            # the file can't hold more than a chunk of Tweets, so there's no need to sample it
+            chunk_bytes = max(file_size,1)
+        else:
+            chunk_bytes = max(1,int(max_tweets*estimate_line_size(file_name)))
+        for start in range(0,max(file_size,1),chunk_bytes):
+            end = min(start + chunk_bytes,file_size)
+            chunks.append((file_name,start,end,end - start))
+    return chunks
+
+# marks a field value that can't be extracted without a full parse
+_UNRESOLVED = object()
+_field_patterns = {}
+
+def extract_top_level_value(raw,key):
+    """
+    Extract the value of a top-level key from a serialized Tweet without parsing 
+    the whole object, or return _UNRESOLVED if that can't be done safely.
+
+    Only scalar values are extracted, and only when the key appears before any
+    nested object (as 'postedTime' and 'verb' do in Gnip Activity Streams
+    payloads), which guarantees that it's a top-level key.
+    """
+    pattern = _field_patterns.get(key)
+    if pattern is None:
+        pattern = _field_patterns[key] = b'"' + key.encode('utf8') + b'":'
+    position = raw.find(pattern)
+    if position == -1 or raw.find(b'{',1,position) != -1:
+        return _UNRESOLVED
+    start = position + len(pattern)
+    if raw[start:start + 1] == b'"':
+        end = raw.find(b'"',start + 1)
+        value = raw[start + 1:end]
+        if end == -1 or b'\\' in value:
+            return _UNRESOLVED
+        return value.decode('utf8')
+    comma, brace = raw.find(b',',start), raw.find(b'}',start)
+    end = min(comma,brace) if comma != -1 and brace != -1 else max(comma,brace)
+    token = raw[start:end].strip()
+    if end == -1 or not token or token[:1] in (b'{',b'['):
+        return _UNRESOLVED
+    try:
+        return json.loads(token)
+    except ValueError:
+        return _UNRESOLVED
+
+class LazyDecodeError(ValueError):
+    """ raised by a LazyTweet whose line can't be decoded """
+
+class LazyTweet(object):
+    """
+    A read-only, dict-like view of a serialized Tweet, which extracts the top-level
+    values that it can from the raw bytes and decodes the full object only when 
+    another value is needed. Decoding errors are raised as LazyDecodeError.
+
+    A line that doesn't end with '}', such as one cut off in writing, is always
+    decoded, so that it's rejected as it would be without lazy decoding. Other
+    malformed lines aren't detected unless a value that can't be extracted is
+    needed, so they may be counted where a full decode would reject them.
+    """
+    __slots__ = ('raw','values','tweet')
+
+    def __init__(self,raw):
+        self.raw = raw if isinstance(raw,bytes) else raw.encode('utf8')
+        self.values = {}
+        self.tweet = None
+
+    def decode(self):
+        if self.tweet is None:
+            try:
+                self.tweet = json.loads(self.raw)
+            except ValueError as e:
+                raise LazyDecodeError(str(e)) from e
+        return self.tweet
+
+    def __getitem__(self,key):
+        if self.tweet is None and not self.values and not self.raw.rstrip().endswith(b'}'):
+            self.decode()
+        if self.tweet is None:
+            value = self.values.get(key,_UNRESOLVED)
+            if value is _UNRESOLVED:
+                value = extract_top_level_value(self.raw,key)
+            if value is not _UNRESOLVED:
+                self.values[key] = value
+                return value
+        return self.decode()[key]
+
+    def get(self,key,default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self,key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+def is_counter(measurement_class):
+    """ a counter defines 'count(tweet)' in place of 'add_tweet' (see 'CounterStore') """
+    return callable(getattr(measurement_class,'count',None)) and not hasattr(measurement_class,'add_tweet')
+
+class CounterStore(object):
+    """
+    Holds the counts of counter measurements for many time buckets in one 
+    array, with a row for each bucket and a column for each counter, rather 
+    than in an instance of each counter class for each bucket.
+
+    A counter is a measurement class that defines 'count(tweet)', returning the
+    amount to add to its count for a Tweet, and 'get_name()', in place of 
+    'add_tweet', 'get' and 'combine'. Each counter class is instantiated once
+    per aggregation, so the '_datekey' config parameter isn't meaningful for 
+    it. If NumPy is available, a counter that declares its fields can also 
+    define 'count_batch(columns)', returning the total for a batch of Tweets 
+    (see 'ColumnBatch').
+
+    The array starts with room for INITIAL_ROWS rows and doubles as needed.
+    A store is pickled as its raw array bytes.
+    """
+    INITIAL_ROWS = 64
+
+    def __init__(self,names):
+        self.names = names
+        self.width = len(names)
+        self.values = array.array('q',[0])*(self.INITIAL_ROWS*self.width)
+        self.n_rows = 0
+        self.free_offsets = []
+
+    def add_row(self):
+        """ return the offset of a new row of zero counts """
+        if len(self.free_offsets) > 0:
+            return self.free_offsets.pop()
+        if (self.n_rows + 1)*self.width > len(self.values):
+            self.values.extend(array.array('q',[0])*len(self.values))
+        offset = self.n_rows*self.width
+        self.n_rows += 1
+        return offset
+
+    def release_row(self,offset):
+        """ zero a row that is no longer needed and reuse it """
+        self.values[offset:offset + self.width] = array.array('q',[0])*self.width
+        self.free_offsets.append(offset)
+
+    def get_counts(self,offset):
+        return self.values[offset:offset + self.width]
+
+    def add_counts(self,offset,counts):
+        self.values[offset:offset + self.width] = array.array('q',map(operator.add,self.get_counts(offset),counts))
+
+    def __getstate__(self):
+        return (self.names,self.n_rows,self.free_offsets,self.values[:self.n_rows*self.width].tobytes())
+
+    def __setstate__(self,state):
+        self.names,self.n_rows,self.free_offsets,values_bytes = state
+        self.width = len(self.names)
+        self.values = array.array('q')
+        self.values.frombytes(values_bytes)
+
+class CounterRow(object):
+    """
+    The counts of one time bucket in a 'CounterStore', which are combined and 
+    output like a measurement that makes a count for each counter.
+    """
+    __slots__ = ('store','offset')
+
+    def __init__(self,store,offset):
+        self.store = store
+        self.offset = offset
+
+    def get(self):
+        return list(zip(self.store.get_counts(self.offset),self.store.names))
+
+    def get_name(self):
+        return 'CounterRow'
+
+    def combine(self,new):
+        self.store.add_counts(self.offset,new.store.get_counts(new.offset))
+
+class ColumnBatch(object):
+    """
+    Accumulates the time bucket and declared field values of Tweets as columns,
+    for the measurements that define 'add_batch'.
+
+    On 'flush', the rows are grouped by time bucket, and the columns of each
+    bucket are passed on as a dict of NumPy arrays, holding the values of the 
+    fields and a 'bucket' column, so that 'len(columns["bucket"])' is the 
+    number of Tweets in the batch. Missing values are None.
+    """
+    MAX_ROWS = 2**16
+
+    def __init__(self,fields):
+        self.fields = fields
+        self.bucket_keys = []
+        self.bucket_indices = {}
+        self.buckets = []
+        self.values = [[] for field in fields]
+
+    def __len__(self):
+        return len(self.buckets)
+
+    def get_row(self,tweet):
+        """ get the field values of a Tweet """
+        return [tweet.get(field) for field in self.fields]
+
+    def add_row(self,time_bucket_key,row):
+        bucket_index = self.bucket_indices.get(time_bucket_key)
+        if bucket_index is None:
+            bucket_index = self.bucket_indices[time_bucket_key] = len(self.bucket_keys)
+            self.bucket_keys.append(time_bucket_key)
+        self.buckets.append(bucket_index)
+        for column,value in zip(self.values,row):
+            column.append(value)
+
+    @staticmethod
+    def _make_array(values):
+        if any(isinstance(value,(list,dict)) for value in values):
+            # nested values are kept as objects; NumPy can't make an array of lists of differing lengths
+            array = np.empty(len(values),dtype=object)
+            array[:] = values
+            return array
+        return np.array(values)
+
+    def flush(self,add_batch):
+        """ call 'add_batch' with the time bucket key and columns of each bucket in the batch """
+        if len(self.buckets) == 0:
+            return
+        buckets = np.array(self.buckets)
+        order = np.argsort(buckets,kind='stable')
+        buckets = buckets[order]
+        columns = [self._make_array(column)[order] for column in self.values]
+        boundaries = np.flatnonzero(np.diff(buckets)) + 1
+        starts = np.concatenate(([0],boundaries))
+        ends = np.concatenate((boundaries,[len(buckets)]))
+        for start,end in zip(starts,ends):
+            bucket_columns = dict(zip(self.fields,(column[start:end] for column in columns)))
+            bucket_columns['bucket'] = buckets[start:end]
+            add_batch(self.bucket_keys[buckets[start]],bucket_columns)
+        self.__init__(self.fields)
+
+class StreamingWindow(object):
+    """
+    Closes the time buckets of a roughly time-ordered stream of Tweets.
+
+    The watermark trails the latest 'postedTime' seen by 'lateness' seconds.
+    Once the watermark passes the end of a time bucket, the bucket is removed
+    from the aggregated data and passed to 'emit'. A Tweet for a bucket that 
+    has already been closed is late; the 'drop' policy discards it, while the
+    'update' policy aggregates it into a new instance of its bucket, which is
+    closed (and emitted as additional rows) when the watermark next advances.
+
+    Parameters
+    ----------
+    time_bucketer : TimeBucketer
+    lateness : int
+        Seconds by which the watermark trails the latest Tweet time
+    late_policy : str
+        'drop' or 'update'
+    emit : callable
+        Called with the time bucket key and measurement instance list of each closed bucket
+    keep_empty_entries : bool
+    """
+    def __init__(self,time_bucketer,lateness,late_policy,emit,keep_empty_entries):
+        self.time_bucketer = time_bucketer
+        self.lateness = lateness
+        self.late_policy = late_policy
+        self.emit = emit
+        self.keep_empty_entries = keep_empty_entries
+        self.latest_posted_time = ''
+        self.watermark = float('-inf')
+        self.bucket_ends = {}
+        self.earliest_end = float('inf')
+        self.n_late = 0
+
+    def accept(self,posted_time,time_bucket_key,data):
+        """ 
+        Advance the watermark for a Tweet, closing buckets in 'data' as needed,
+        and return False if the Tweet should be dropped
+        """
+        # 'postedTime' strings sort in time order, so the watermark is only recomputed for a new latest time
+        if posted_time > self.latest_posted_time:
+            self.latest_posted_time = posted_time
+            self.watermark = self.time_bucketer.get_epoch(posted_time) - self.lateness
+            if self.watermark >= self.earliest_end:
+                self._close_buckets(data)
+        bucket_end = self.bucket_ends.get(time_bucket_key)
+        is_new_bucket = bucket_end is None
+        if is_new_bucket:
+            bucket_end = self.time_bucketer.get_start(time_bucket_key) + self.time_bucketer.bucket_size_in_sec
+        # with the 'update' policy, a bucket reopened by a late Tweet stays open until the watermark next advances
+        if bucket_end <= self.watermark:
+            self.n_late += 1
+            if self.late_policy == 'drop':
+                return False
+        if is_new_bucket:
+            self.bucket_ends[time_bucket_key] = bucket_end
+            self.earliest_end = min(self.earliest_end,bucket_end)
+        return True
+
+    def _close_buckets(self,data,close_all=False):
+        closed_keys = sorted(time_bucket_key for time_bucket_key,bucket_end in self.bucket_ends.items() 
+                if close_all or bucket_end <= self.watermark)
+        for time_bucket_key in closed_keys:
+            del self.bucket_ends[time_bucket_key]
+            measurements = data.pop(time_bucket_key)
+            if not self.keep_empty_entries:
+                measurements = [measurement for measurement in measurements if measurement.get() != 0]
+            self.emit(time_bucket_key,measurements)
+        self.earliest_end = min(self.bucket_ends.values(),default=float('inf'))
+
+    def close(self,data):
+        """ close all remaining buckets, at the end of the stream """
+        self._close_buckets(data,close_all=True)
+        if self.n_late > 0:
+            logger.info('{} late Tweets were {}'.format(self.n_late,'dropped' if self.late_policy == 'drop' else 'emitted as updates'))
+
+class TimedMeasurement(object):
+    """ records the time of each 'add_tweet' call of a measurement """
+    def __init__(self,measurement):
+        self.measurement = measurement
+        self.name = 'add_tweet.' + type(measurement).__name__
+
+    def add_tweet(self,tweet):
+        start_time = time.perf_counter()
+        try:
+            self.measurement.add_tweet(tweet)
+        finally:
+            stats.add_time(self.name,time.perf_counter() - start_time)
+
+def timed(func,name):
+    """ wrap a function so that the time of each call is recorded """
+    def timed_func(*args):
+        start_time = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            stats.add_time(name,time.perf_counter() - start_time)
+    return timed_func
+
 def aggregate(line_generator,
-        TWITTER_DT_FORMAT_STR,
-        dt_bucket_format,
+        time_bucketer,
         config_kwargs,
         measurement_class_list,
-        keep_empty_entries):  
+        keep_empty_entries,
+        streaming_window=None):  
     """
     Aggregator acting on an interable
+
+    If a 'streaming_window' is given, time buckets are closed and emitted 
+    as the stream is processed, and the returned data holds only the buckets
+    that remain open.
+
+    If every measurement class declares the Tweet fields that it uses, with a
+    'fields' class attribute, measurements get 'LazyTweet' objects, and each
+    Tweet is only fully decoded if a measurement needs a value that can't 
+    be extracted from the raw line. The declared fields are fetched before any
+    measurement is updated, so that a line that fails to decode is skipped
+    without creating a time bucket; lines aren't otherwise validated (see 
+    'LazyTweet').
+
+    If NumPy is available, measurements that declare their fields and define
+    'add_batch' are updated with columns of Tweet values (see 'ColumnBatch')
+    rather than once per Tweet. Other measurements get 'add_tweet' calls,
+    as do all measurements in streaming mode.
+
+    Counter measurements (see 'CounterStore') are kept in a 'CounterStore', 
+    and each time bucket holds a 'CounterRow' in place of their instances.
+
+    With '--stats-file', the time spent parsing and bucketing each Tweet, and 
+    in each measurement, is recorded.
     """
     data = {}
+    lazy_decoding = len(measurement_class_list) > 0 and all(hasattr(measurement,'fields') 
+            for measurement in measurement_class_list)
+    if lazy_decoding:
+        lazy_fields = []
+        for measurement in measurement_class_list:
+            lazy_fields.extend(field for field in measurement.fields if field not in lazy_fields)
+
+    ## counters share one store, while other measurements are instantiated for each time bucket 
+    counters = [measurement(**config_kwargs) for measurement in measurement_class_list if is_counter(measurement)]
+    instance_classes = [measurement for measurement in measurement_class_list if not is_counter(measurement)]
+    counter_store = CounterStore([counter.get_name() for counter in counters]) if len(counters) > 0 else None
+    counts = counter_store.values if counter_store is not None else None
+
+    vectorized = np is not None and streaming_window is None
+    batch_positions = [position for position,measurement in enumerate(instance_classes)
+            if vectorized and hasattr(measurement,'add_batch') and hasattr(measurement,'fields')]
+    tweet_positions = [position for position in range(len(instance_classes)) if position not in batch_positions]
+    batch_counters = [(column,counter.count_batch) for column,counter in enumerate(counters)
+            if vectorized and hasattr(counter,'count_batch') and hasattr(counter,'fields')]
+    tweet_counters = [(column,counter.count) for column,counter in enumerate(counters) 
+            if column not in dict(batch_counters)]
+    if stats is not None:
+        tweet_counters = [(column,timed(count,'count.' + counters[column].get_name())) for column,count in tweet_counters]
+    if len(batch_positions) > 0 or len(batch_counters) > 0:
+        batch_fields = []
+        for measurement in [instance_classes[position] for position in batch_positions] + [counters[column] for column,_ in batch_counters]:
+            batch_fields.extend(field for field in measurement.fields if field not in batch_fields)
+        column_batch = ColumnBatch(tuple(batch_fields))
+        if stats is not None:
+            column_batch.flush = timed(column_batch.flush,'add_batch')
+    else:
+        column_batch = None
+
+    # the add_tweet measurements, add_batch measurements and counter row offset of each time bucket
+    bucket_state = {}
+
+    def add_batch(time_bucket_key,columns):
+        _, batch_measurements, offset = bucket_state[time_bucket_key]
+        for measurement in batch_measurements:
+            measurement.add_batch(columns)
+        for column,count_batch in batch_counters:
+            counts[offset + column] += int(count_batch(columns))
 
     for tweet_str in line_generator:
-        try:
-            tweet = json.loads(tweet_str)  
-        except ValueError:
-            continue
+        if stats is not None:
+            parse_start_time = time.perf_counter()
+        if lazy_decoding:
+            tweet = LazyTweet(tweet_str)
+        else:
+            try:
+                tweet = json.loads(tweet_str)  
+            except ValueError:
+                continue
 
         ## throw away Tweets without times (compliance activities)
-        if "postedTime" not in tweet:
+        try:
+            posted_time = tweet["postedTime"]
+            if lazy_decoding:
+                # a line that fails to decode is skipped here, before it changes any measurement
+                for field in lazy_fields:
+                    tweet.get(field)
+        except (KeyError,LazyDecodeError):
             continue
         
-        time_bucket_key = datetime.datetime.strptime(tweet["postedTime"],
-                TWITTER_DT_FORMAT_STR).strftime(dt_bucket_format)
+        if stats is not None:
+            bucket_start_time = time.perf_counter()
+            stats.add_time('parse',bucket_start_time - parse_start_time)
+        time_bucket_key = time_bucketer.get_key(posted_time)
+        if stats is not None:
+            stats.add_time('bucket',time.perf_counter() - bucket_start_time)
+
+        if streaming_window is not None and not streaming_window.accept(posted_time,time_bucket_key,data):
+            continue
         
         ## for a new time bucket, we need to initialize the data objects
         if time_bucket_key not in data:
-            data[time_bucket_key] = []
+            if streaming_window is not None:
+                # release the state of buckets that the streaming window has closed
+                for closed_key in [key for key in bucket_state if key not in data]:
+                    if counter_store is not None:
+                        counter_store.release_row(bucket_state[closed_key][2])
+                    del bucket_state[closed_key]
             config_kwargs["_datekey"] = time_bucket_key
-            for measurement in measurement_class_list:
-                # measurement class instances are all constructed with kw args
-                data[time_bucket_key].append( measurement(**config_kwargs) ) 
+            # measurement class instances are all constructed with kw args
+            instances = [measurement(**config_kwargs) for measurement in instance_classes]
+            data[time_bucket_key] = list(instances)
+            offset = None
+            if counter_store is not None:
+                offset = counter_store.add_row()
+                data[time_bucket_key].append( CounterRow(counter_store,offset) )
+            tweet_measurements = [instances[position] for position in tweet_positions]
+            if stats is not None:
+                tweet_measurements = [TimedMeasurement(measurement) for measurement in tweet_measurements]
+            bucket_state[time_bucket_key] = (tweet_measurements,
+                    [instances[position] for position in batch_positions],
+                    offset)
         
         ## get the measurement instances for this bucket
-        data_bucket = data[time_bucket_key] 
+        tweet_measurements, _, offset = bucket_state[time_bucket_key]
 
         ## update all the measurements 
-        for measurement in data_bucket:
+        if column_batch is not None:
+            row = column_batch.get_row(tweet)
+        for measurement in tweet_measurements:
             measurement.add_tweet(tweet)
+        for column,count in tweet_counters:
+            counts[offset + column] += count(tweet)
+        if column_batch is not None:
+            column_batch.add_row(time_bucket_key,row)
+            if len(column_batch) >= column_batch.MAX_ROWS:
+                column_batch.flush(add_batch)
 
-    if not keep_empty_entries:
+    if column_batch is not None:
+        column_batch.flush(add_batch)
+
+    if not keep_empty_entries and streaming_window is None:
         for dt_key,instance_list in data.items():
             for instance in instance_list:
                 if instance.get() == 0:
@@ -94,6 +687,36 @@ def aggregate(line_generator,
     
     return data
     
+class Combiner(object):
+    """
+    Combines measurements across results objects as they are added.
+
+    Each results object is a dict of (date_time_bucket, measurement_instance_list) 
+    pairs, calculated for a different input chunk. Within each time bucket, the
+    combined measurements are indexed by name, so each incoming measurement is
+    merged with one dict lookup.
+    """
+    def __init__(self):
+        self.reduced_data = {}
+
+    def add(self,chunk_data):
+        for time_bucket_key,measurements in chunk_data.items():
+            reduced_bucket = self.reduced_data.get(time_bucket_key)
+            if reduced_bucket is None:
+                reduced_bucket = self.reduced_data[time_bucket_key] = {}
+            for measurement in measurements:
+                name = measurement.get_name()
+                existing_measurement = reduced_bucket.get(name)
+                if existing_measurement is None:
+                    reduced_bucket[name] = measurement
+                else:
+                    existing_measurement.combine(measurement)
+
+    def get_data(self):
+        """ return the combined results object """
+        return {time_bucket_key:list(reduced_bucket.values()) 
+                for time_bucket_key,reduced_bucket in self.reduced_data.items()}
+
 def combine(data):
     """ 
     Combine measurements across items in 'data'
@@ -102,22 +725,197 @@ def combine(data):
     for different input files. Each results object is a dict
     of (date_time_bucket, measurement_instance_list) pairs.
     """
-    reduced_data = {}
+    combiner = Combiner()
     for chunk_data in data:
-        for time_bucket_key,measurements in chunk_data.items():
-            for measurement in measurements:
-                if time_bucket_key not in reduced_data:
-                    reduced_data[time_bucket_key] = [measurement]
-                else:
-                    measurement_exists = False
-                    for existing_measurement in reduced_data[time_bucket_key]:
-                        if measurement.get_name() == existing_measurement.get_name():
-                            existing_measurement.combine(measurement)
-                            measurement_exists = True
-                    # add measurement if not found in reduced data for this time bucket
-                    if measurement_exists is False:
-                        reduced_data[time_bucket_key].append(measurement)
-    return reduced_data
+        combiner.add(chunk_data)
+    return combiner.get_data()
+
+def aggregate_chunks(chunks,
+        time_bucketer,
+        config_kwargs,
+        measurement_class_list,
+        keep_empty_entries,
+        by_file=False):
+    """
+    Aggregate several input chunks in one process and combine their results;
+    this is the first level of a tree reduction over many input chunks.
+    A chunk is a byte range of a file (see 'make_chunks'), or a list of lines.
+
+    Returns the combined results object, and a list of 
+    (chunk description, chunk size in bytes, aggregation time in seconds) tuples.
+    If 'by_file' is set, the results of each file's chunks are combined separately,
+    and the results object is replaced by a dict of 
+    (file name, (results object, number of chunks)) pairs.
+    """
+    combiners = collections.defaultdict(Combiner)
+    n_chunks = collections.Counter()
+    chunk_timings = []
+    for chunk in chunks:
+        start_time = time.time()
+        if isinstance(chunk,list):
+            chunk_description = 'stdin chunk'
+            chunk_size = sum(len(line) for line in chunk)
+            chunk_data = aggregate(chunk,
+                time_bucketer,
+                config_kwargs,
+                measurement_class_list,
+                keep_empty_entries)
+        else:
+            file_name,start,end,chunk_size = chunk
+            if start is None:
+                chunk_description = file_name
+                chunk_data = aggregate_file(file_name,
+                    time_bucketer,
+                    config_kwargs,
+                    measurement_class_list,
+                    keep_empty_entries)
+            else:
+                chunk_description = '{}[{}:{}]'.format(file_name,start,end)
+                chunk_data = aggregate(read_file_range(file_name,start,end),
+                    time_bucketer,
+                    config_kwargs,
+                    measurement_class_list,
+                    keep_empty_entries)
+        combine_start_time = time.time()
+        combiners[chunk[0] if by_file else None].add(chunk_data)
+        n_chunks[chunk[0] if by_file else None] += 1
+        chunk_timings.append((chunk_description,chunk_size,combine_start_time - start_time))
+        if stats is not None:
+            stats.add_time('chunk',combine_start_time - start_time)
+            stats.add_time('combine',time.time() - combine_start_time)
+            stats.count('chunk_bytes',chunk_size)
+    if by_file:
+        return {file_name:(combiner.get_data(),n_chunks[file_name]) for file_name,combiner in combiners.items()}, chunk_timings
+    return combiners[None].get_data(), chunk_timings
+
+def get_config_hash(config_file,time_bucketer,keep_empty_entries):
+    """ hash the settings that aggregated results depend on, including the config file contents """
+    config_hash = hashlib.sha1('{} {}'.format(time_bucketer.bucket_size_in_sec,keep_empty_entries).encode('utf8'))
+    if config_file is not None:
+        with open(config_file,'rb') as f:
+            config_hash.update(f.read())
+    return config_hash.hexdigest()
+
+class StateStore(object):
+    """
+    Keeps the aggregated results of each input file in an SQLite database,
+    keyed by its path and the hash of the configuration, and checked against
+    its size and modification time, so that unchanged files aren't aggregated
+    again. Each file's results are committed as soon as they are stored,
+    so an interrupted run resumes from the files it completed.
+    """
+    def __init__(self,file_name,config_hash):
+        self.config_hash = config_hash
+        self.db = sqlite3.connect(file_name,timeout=60)
+        self.db.execute('CREATE TABLE IF NOT EXISTS file_results (path TEXT, config_hash TEXT, size INTEGER, mtime INTEGER, data BLOB, PRIMARY KEY (path,config_hash))')
+        self.db.commit()
+
+    @staticmethod
+    def get_key(file_name):
+        stat = os.stat(file_name)
+        return os.path.abspath(file_name), stat.st_size, stat.st_mtime_ns
+
+    def get(self,file_name):
+        """ return the stored results object for a file, or None if it's missing or out of date """
+        path, size, mtime = self.get_key(file_name)
+        row = self.db.execute('SELECT data FROM file_results WHERE path = ? AND config_hash = ? AND size = ? AND mtime = ?',
+                (path,self.config_hash,size,mtime)).fetchone()
+        return pickle.loads(row[0]) if row is not None else None
+
+    def put(self,file_name,data):
+        path, size, mtime = self.get_key(file_name)
+        self.db.execute('INSERT OR REPLACE INTO file_results VALUES (?,?,?,?,?)',
+                (path,self.config_hash,size,mtime,sqlite3.Binary(pickle.dumps(data,pickle.HIGHEST_PROTOCOL))))
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+def make_chunk_groups(chunks,chunks_per_task):
+    """
+    Group input chunks into process tasks of similar total size, with the 
+    largest chunks spread across tasks, and return the groups largest first,
+    so that the big tasks don't become stragglers at the end of a run
+    """
+    n_groups = (len(chunks) + chunks_per_task - 1)//chunks_per_task
+    groups = [[0,[]] for _ in range(n_groups)]
+    # a heap of (total size,index) of the groups that aren't full
+    open_groups = [(0,i) for i in range(n_groups)]
+    for chunk in sorted(chunks,key=lambda chunk: chunk[3],reverse=True):
+        # add each chunk to the smallest group that isn't full
+        _, i = heapq.heappop(open_groups)
+        groups[i][0] += chunk[3]
+        groups[i][1].append(chunk)
+        if len(groups[i][1]) < chunks_per_task:
+            heapq.heappush(open_groups,(groups[i][0],i))
+    return [chunks for _,chunks in sorted(groups,key=lambda group: group[0],reverse=True)]
+
+def format_csv_rows(time_bucket_key,measurements,time_bucketer):
+    """ make the CSV output rows for the measurements of a time bucket """
+    rows = []
+    # the format of this string must be parsable by dateutil.parser.parse
+    time_bucket_start = datetime.datetime.strptime(time_bucket_key,time_bucketer.key_format).strftime('%Y%m%d%H%M%S')
+    for measurement in measurements:
+        for count,counter_name in measurement.get():
+            csv_string = u'{0:d},{1},{2},{3:s}'.format(int(time_bucket_start),
+                    time_bucketer.bucket_size_in_sec,
+                    count,
+                    counter_name
+                    )
+            rows.append(csv_string)
+    return rows
+
+def write_csv_rows(time_bucket_key,measurements,time_bucketer):
+    """ write the sorted CSV output rows for a time bucket as soon as it's closed """
+    output_str = ''.join(row + '\n' for row in sorted(format_csv_rows(time_bucket_key,measurements,time_bucketer)))
+    sys.stdout.write(output_str)
+    sys.stdout.flush()
+
+def write_csv_output(data,time_bucketer):
+    """ write the sorted CSV output rows for a results object """
+    output_list = []
+    for time_bucket_key,measurements in data.items():
+        output_list.extend(format_csv_rows(time_bucket_key,measurements,time_bucketer))
+
+    output_str = '\n'.join(sorted(output_list))
+    output_str += '\n'
+    if sys.version_info[0] < 3:
+        output_str = output_str.encode('utf8')
+    try:
+        sys.stdout.write(output_str) 
+    except IOError:
+        pass
+
+PARTIAL_FILE_MAGIC = b'TSPARTL\n'
+PARTIAL_FILE_VERSION = 1
+
+def write_partial_file(file_name,data,header):
+    """
+    Write a results object to a partial results file, which holds the magic 
+    bytes, the format version and header length (as big-endian unsigned short 
+    and int), a JSON header, and the zlib-compressed pickle of the results object.
+    The file is written under a temporary name and then renamed.
+    """
+    header_bytes = json.dumps(header).encode('utf8')
+    with open(file_name + '.tmp','wb') as f:
+        f.write(PARTIAL_FILE_MAGIC)
+        f.write(struct.pack('>HI',PARTIAL_FILE_VERSION,len(header_bytes)))
+        f.write(header_bytes)
+        f.write(zlib.compress(pickle.dumps(data,pickle.HIGHEST_PROTOCOL)))
+    os.replace(file_name + '.tmp',file_name)
+
+def read_partial_file(file_name):
+    """ return the header and results object of a partial results file """
+    with open(file_name,'rb') as f:
+        if f.read(len(PARTIAL_FILE_MAGIC)) != PARTIAL_FILE_MAGIC:
+            raise ValueError('{} is not a partial results file'.format(file_name))
+        version, header_length = struct.unpack('>HI',f.read(6))
+        if version > PARTIAL_FILE_VERSION:
+            raise ValueError('{} has partial results format version {}; version {} is the latest supported'.format(
+                file_name,version,PARTIAL_FILE_VERSION))
+        header = json.loads(f.read(header_length).decode('utf8'))
+        data = pickle.loads(zlib.decompress(f.read()))
+    return header, data
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser("Produce time series data from Tweet records")
@@ -125,15 +923,35 @@ if __name__ == "__main__":
     parser.add_argument('-i','--input-files',dest='input_files',nargs="+",
             default=None,help="input files; if unspecified, stdin is used")
     parser.add_argument('-b','--bucket-size',dest='bucket_size',
-            default="day",help="bucket size: second,minute,hour,day; default is %(default)s")
+            default="day",help="bucket size: second,minute,hour,day, a multiple like 5minute, or a number of seconds; default is %(default)s")
     parser.add_argument('-e','--keep-empty-entries',dest='keep_empty_entries',
             action="store_true",default=False,help="print empty instances; default is %(default)s") 
     parser.add_argument('-c','--config-file',dest='config_file',
             default=None,help='file with local definitions of measurement classes and config')
     parser.add_argument('-m','--max-tweets',dest='max_tweets',type=int,
-            default=1000000,help="max number of tweets per aggregator process")
+            default=None,help="approximate number of tweets per chunk of an input file or stdin, where chunks are aggregated in parallel; default is {} for files and {} for stdin".format(DEFAULT_FILE_CHUNK_TWEETS,DEFAULT_STDIN_CHUNK_TWEETS))
     parser.add_argument('-p','--num-cpu',dest='num_cpu',type=int,
             default=1,help="number of parallel aggregator process")
+    parser.add_argument('-f','--chunks-per-task',dest='chunks_per_task',type=int,
+            default=None,help="number of input chunks aggregated and combined by each process task; default is enough for about 4 tasks per process")
+    parser.add_argument('-s','--stream',dest='stream',action='store_true',
+            default=False,help="with stdin input, write each time bucket once the watermark passes it; default is %(default)s")
+    parser.add_argument('-w','--lateness',dest='lateness',type=int,
+            default=60,help="seconds by which the streaming watermark trails the latest Tweet; default is %(default)s")
+    parser.add_argument('--late-policy',dest='late_policy',choices=['drop','update'],
+            default='drop',help="in streaming mode, drop Tweets for closed buckets, or emit them as additional rows; default is %(default)s")
+    parser.add_argument('--state-file',dest='state_file',
+            default=None,help="SQLite file keeping the results of each input file, so that later runs only aggregate new or changed files; requires -i")
+    parser.add_argument('--write-partial',dest='partial_file',
+            default=None,help="write the results to this partial results file, to be merged with --merge-partials, instead of CSV")
+    parser.add_argument('--merge-partials',dest='merge_partials',nargs="+",
+            default=None,help="combine these partial results files, written with the same config file, instead of aggregating Tweets")
+    parser.add_argument('--stats-file',dest='stats_file',
+            default=None,help='append JSON lines of parse, bucketing, measurement and combine times for each process to this file, or "-" for stderr')
+    parser.add_argument('--stats-interval',dest='stats_interval',type=float,
+            default=10.,help="seconds between JSON stats lines; default is %(default)s")
+    parser.add_argument('--profile-dir',dest='profile_dir',
+            default=None,help="write a cProfile file for the main process and each aggregator process to this directory")
     parser.add_argument('-v','--verbose',dest='verbose',action='store_true',
             default=False,help="produce verbose output; default is %(default)s")
     args = parser.parse_args()  
@@ -142,6 +960,9 @@ if __name__ == "__main__":
         logger.setLevel(logging.DEBUG)
         handler.setLevel(logging.DEBUG)
 
+    stats = Stats(args.stats_file,args.stats_interval) if args.stats_file is not None else None
+    start_instrumentation(stats,args.profile_dir,'main')
+
     # default measurements list
     measurement_class_list = []
 
@@ -169,78 +990,150 @@ if __name__ == "__main__":
         logger.info('No configuration file specified; no measurements will be run.\n')
 
 
-    if args.bucket_size == "second":
-        time_bucket_size_in_sec = 1 
-        dt_bucket_format = "%Y%m%d%H%M%S"
-    elif args.bucket_size == "minute":
-        time_bucket_size_in_sec = 60 
-        dt_bucket_format = "%Y%m%d%H%M"
-    elif args.bucket_size == "hour":
-        time_bucket_size_in_sec = 3600 
-        dt_bucket_format = "%Y%m%d%H"
-    elif args.bucket_size == "day":
-        time_bucket_size_in_sec = 3600*24    
-        dt_bucket_format = "%Y%m%d"
-    else:
-        raise ValueError("Time bucket size '{}' is not implemented".format(args.bucket_size)) 
+    time_bucket_size_in_sec = parse_bucket_size(args.bucket_size)
+    time_bucketer = TimeBucketer(time_bucket_size_in_sec)
+    config_hash = get_config_hash(args.config_file,time_bucketer,args.keep_empty_entries)
+    partial_header = {'bucket_size_in_sec':time_bucket_size_in_sec,
+            'keep_empty_entries':args.keep_empty_entries,
+            'config_hash':config_hash}
+
+    if args.merge_partials is not None:
+        if args.input_files is not None or args.stream:
+            parser.error('merging partial results (--merge-partials) reads no Tweets')
+        combiner = Combiner()
+        bucket_size_in_sec = None
+        for file_name in args.merge_partials:
+            header, partial_data = read_partial_file(file_name)
+            if bucket_size_in_sec is not None and header['bucket_size_in_sec'] != bucket_size_in_sec:
+                parser.error('partial results files have different bucket sizes')
+            bucket_size_in_sec = header['bucket_size_in_sec']
+            if header['config_hash'] != get_config_hash(args.config_file,TimeBucketer(bucket_size_in_sec),header['keep_empty_entries']):
+                logger.warning('{} was written with a different config file'.format(file_name))
+            combiner.add(partial_data)
+        # the bucket size is the one that the partial results were written with
+        time_bucketer = TimeBucketer(bucket_size_in_sec)
+        partial_header = dict(header,config_hash=get_config_hash(args.config_file,time_bucketer,header['keep_empty_entries']))
+        if args.partial_file is not None:
+            write_partial_file(args.partial_file,combiner.get_data(),partial_header)
+        else:
+            write_csv_output(combiner.get_data(),time_bucketer)
+        sys.exit(0)
+
+    if args.stream:
+        if args.input_files is not None:
+            parser.error('streaming mode (-s) reads from stdin')
+        if args.partial_file is not None:
+            parser.error('streaming mode (-s) writes CSV rows as buckets are closed')
+        streaming_window = StreamingWindow(time_bucketer,args.lateness,args.late_policy,
+                lambda time_bucket_key,measurements: write_csv_rows(time_bucket_key,measurements,time_bucketer),
+                args.keep_empty_entries)
+        try:
+            streaming_window.close( aggregate(read_lines(['-']),
+                time_bucketer,
+                config_kwargs,
+                measurement_class_list,
+                args.keep_empty_entries,
+                streaming_window) )
+        except IOError:
+            pass
+        sys.exit(0)
+
+    state_store = None
+    if args.state_file is not None:
+        if args.input_files is None:
+            parser.error('a state file (--state-file) requires input files (-i)')
+        state_store = StateStore(args.state_file,config_hash)
 
     ## process the Tweets 
-    data = []
-    if args.input_files is None: 
+    combiner = Combiner()
+    aggregate_task = functools.partial(aggregate_chunks,
+            time_bucketer=time_bucketer,
+            config_kwargs=config_kwargs,
+            measurement_class_list=measurement_class_list,
+            keep_empty_entries=args.keep_empty_entries,
+            by_file=state_store is not None)
+    if args.input_files is None and args.num_cpu == 1: 
         # we're reading from stdin and running a single-process
-        data.append( aggregate(sys.stdin,
-            TWITTER_DT_FORMAT_STR,
-            dt_bucket_format,
+        combiner.add( aggregate(read_lines(['-']),
+            time_bucketer,
             config_kwargs,
             measurement_class_list,
             args.keep_empty_entries) )
     else:
-        # we will process each input file in a separate process
-        mapping_results = []
-        pool = multiprocessing.Pool(processes=args.num_cpu)
-        for chunk_idx, file_name in enumerate(args.input_files): 
-            logger.debug("Submitting chunk " + str(chunk_idx))
-            mapping_results.append( pool.apply_async(aggregate_file,(file_name,
-                TWITTER_DT_FORMAT_STR,
-                dt_bucket_format,
-                config_kwargs,
-                measurement_class_list,
-                args.keep_empty_entries) ) ) 
-
-        # collect results as they finish
-        while len(mapping_results) > 0:
-            for result in mapping_results:
-                if result.ready():
-                    data.append(result.get())
-                    mapping_results.remove(result)
-                    break
-            time.sleep(0.1)
-            if datetime.datetime.now().second%10 == 0:
-                time.sleep(1)
-                logger.debug(str(len(mapping_results)) + ' chunks remaining')
+        # we will process groups of input chunks in separate processes, 
+        # combining results within each group before they are returned
+        pool = multiprocessing.Pool(processes=args.num_cpu,
+                initializer=start_instrumentation,initargs=(stats,args.profile_dir,'aggregator'))
+        if args.input_files is None:
+            # stdin is split into chunks of lines, with a bounded number in flight
+            slots = threading.Semaphore(args.num_cpu*2)
+            max_tweets = args.max_tweets or DEFAULT_STDIN_CHUNK_TWEETS
+            tasks = ([chunk] for chunk in chunk_lines(read_lines(['-']),max_tweets,slots))
+            n_tasks = None
+        else:
+            input_files = args.input_files
+            if state_store is not None:
+                # the stored results of unchanged files are combined without aggregating them again
+                input_files = []
+                for file_name in args.input_files:
+                    file_data = state_store.get(file_name)
+                    if file_data is None:
+                        input_files.append(file_name)
+                    else:
+                        combiner.add(file_data)
+                logger.info('Using stored results for {} of {} input files'.format(
+                    len(args.input_files) - len(input_files),len(args.input_files)))
+            chunks = make_chunks(input_files,args.max_tweets or DEFAULT_FILE_CHUNK_TWEETS)
+            if state_store is not None:
+                file_combiners = collections.defaultdict(Combiner)
+                remaining_chunks = collections.Counter(chunk[0] for chunk in chunks)
+            chunks_per_task = args.chunks_per_task
+            if chunks_per_task is None:
+                chunks_per_task = max(1,len(chunks)//(args.num_cpu*4))
+            tasks = make_chunk_groups(chunks,chunks_per_task)
+            n_tasks = len(tasks)
 
-    ## combine the measurements
-    combined_data = combine(data)
+        # combine results as they finish
+        start_time = time.time()
+        total_size = 0
+        for task_idx,(task_data,chunk_timings) in enumerate(pool.imap_unordered(aggregate_task,tasks)):
+            if args.input_files is None:
+                slots.release()
+            combine_start_time = time.time()
+            if state_store is not None:
+                # each file's results are stored once all of its chunks are combined
+                for file_name,(file_data,n_chunks) in task_data.items():
+                    file_combiners[file_name].add(file_data)
+                    remaining_chunks[file_name] -= n_chunks
+                    if remaining_chunks[file_name] == 0:
+                        file_data = file_combiners.pop(file_name).get_data()
+                        state_store.put(file_name,file_data)
+                        combiner.add(file_data)
+            else:
+                combiner.add(task_data)
+            if stats is not None:
+                stats.add_time('combine',time.time() - combine_start_time)
+            for chunk_description,chunk_size,elapsed in chunk_timings:
+                total_size += chunk_size
+                logger.debug('Aggregated {} ({:.1f} MB) in {:.2f} s ({:.1f} MB/s)'.format(chunk_description,
+                    chunk_size/1e6,elapsed,chunk_size/1e6/max(elapsed,1e-6)))
+            if n_tasks is not None:
+                logger.debug('{} of {} tasks remaining'.format(n_tasks - task_idx - 1,n_tasks))
+        pool.close()
+        pool.join()
+        elapsed = time.time() - start_time
+        logger.debug('Aggregated {:.1f} MB in {:.2f} s ({:.1f} MB/s)'.format(
+            total_size/1e6,elapsed,total_size/1e6/max(elapsed,1e-6)))
 
-    ## output the data in CSV
-    output_list = []
-    for time_bucket_key,measurements in combined_data.items():
-        # the format of this string must be parsable by dateutil.parser.parse
-        time_bucket_start = datetime.datetime.strptime(time_bucket_key,dt_bucket_format).strftime('%Y%m%d%H%M%S')
-        for measurement in measurements:
-            for count,counter_name in measurement.get():
-                csv_string = u'{0:d},{1},{2},{3:s}'.format(int(time_bucket_start),
-                        time_bucket_size_in_sec,
-                        count,
-                        counter_name
-                        )
-                output_list.append(csv_string)
+    if state_store is not None:
+        state_store.close()
 
-    output_str = '\n'.join(sorted(output_list))
-    output_str += '\n'
-    if sys.version_info[0] < 3:
-        output_str = output_str.encode('utf8')
-    try:
-        sys.stdout.write(output_str) 
-    except IOError:
-        pass
+    combined_data = combiner.get_data()
+
+    if args.partial_file is not None:
+        write_partial_file(args.partial_file,combined_data,partial_header)
+    else:
+        write_csv_output(combined_data,time_bucketer)
+
+    if stats is not None:
+        stats.stop()